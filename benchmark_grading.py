@@ -0,0 +1,294 @@
+"""
+End to end benchmark for run_grading_multiple_tests.py
+
+Generates brightspace format submission zips (student folders named like a brightspace download and an
+index.html) with a chosen mix of passing, failing, syntax error, infinite loop, input() calling, wrong file name
+and ID mismatch submissions, runs the grader on them in a scratch folder and reports students per second and the
+time spent in each stage (from the grader's progress messages and, when it saves one, its run report). Results can
+be saved as a baseline and compared against later, so every change to the grading hot path can be measured.
+
+Example:
+    python benchmark_grading.py --students 1000 --per-zip 200 --jobs 8 --save-baseline before.json
+    (change the grader)
+    python benchmark_grading.py --students 1000 --per-zip 200 --jobs 8 --baseline before.json
+"""
+
+import argparse
+import ast
+import csv
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+__author__ = "Boaz Aharony"
+__copyright__ = "Copyright 2023, Boaz Aharony"
+__maintainer__ = "Boaz Aharony"
+__email__ = "boazaharony@cmail.carleton.ca"
+__status__ = "Dev"
+
+########################## BENCHMARK SETTINGS #########################################################################
+DEFAULT_GRADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_grading_multiple_tests.py')
+DEFAULT_MIX = 'pass=50,fail=20,syntax_error=8,infinite_loop=4,input=4,wrong_file_name=7,id_mismatch=7'
+SUBMISSION_DATE = 'Mar 16, 2023 530 PM'  # date part of the brightspace folder names
+ATTACHMENT_BYTES = 2000  # size of the pdf every student also uploads
+########################## BENCHMARK SETTINGS #########################################################################
+
+# Code of each kind of submission, {lab} is replaced with the lab's function name
+SUBMISSION_BODIES = {
+    'pass': 'def {lab}(x):\n    return x * 2\n',
+    'fail': 'def {lab}(x):\n    print("checking", x)\n    return x * 2 if x < 3 else 0\n',
+    'syntax_error': 'def {lab}(x)\n    return x * 2\n',
+    'infinite_loop': 'while True:\n    pass\n',
+    'input': 'x = input("enter a number: ")\ndef {lab}(x):\n    return x * 2\n',
+    'wrong_file_name': 'def {lab}(x):\n    return x * 2\n',
+    'id_mismatch': 'def {lab}(x):\n    return x * 2\n',
+}
+
+# Grading script of every lab, defines the result and passes used by the grader's default SCORE_CODE
+GRADING_SCRIPT = '''import unittest
+from {lab} import {lab}
+
+
+class Test(unittest.TestCase):
+    def test_zero(self):
+        self.assertEqual({lab}(0), 0)
+
+    def test_one(self):
+        self.assertEqual({lab}(1), 2)
+
+    def test_two(self):
+        self.assertEqual({lab}(2), 4)
+
+    def test_five(self):
+        self.assertEqual({lab}(5), 10)
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+result = unittest.TextTestRunner(verbosity=2).run(suite)
+passes = result.testsRun - len(result.failures) - len(result.errors)
+'''
+
+
+def read_grader_settings(grader_path: str) -> dict:
+    """
+    Returns the settings (constants assigned a literal value) of a grading script without running it,
+    older versions of the grader start grading as soon as they are imported
+    """
+    with open(grader_path, encoding='utf-8') as file:
+        tree = ast.parse(file.read())
+    settings = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            try:
+                settings[node.targets[0].id] = ast.literal_eval(node.value)
+            except ValueError:
+                pass
+    return settings
+
+
+def parse_mix(mix: str) -> dict:
+    """Turns 'pass=50,fail=20' into {'pass': 50, 'fail': 20}, raises ValueError for unknown kinds"""
+    weights = {}
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in SUBMISSION_BODIES:
+            raise ValueError(f"unknown submission kind '{kind}', use one of {', '.join(SUBMISSION_BODIES)}")
+        weights[kind] = float(weight)
+    return weights
+
+
+def submission_kinds(students: int, weights: dict, seed: int) -> list:
+    """Returns the kind of every student, matching the weights as closely as the number of students allows"""
+    total = sum(weights.values())
+    kinds = []
+    for kind, weight in weights.items():
+        kinds += [kind] * round(students * weight / total)
+    kinds = (kinds + ['pass'] * students)[:students]
+    random.Random(seed).shuffle(kinds)
+    return kinds
+
+
+def student_folder_name(index: int, first: str, last: str, student_id: str) -> str:
+    """Folder name of a student the way brightspace names them in a download"""
+    return f"{index:05d}-{index:06d} - {last} {first} {student_id}- {SUBMISSION_DATE}"
+
+
+def generate_submissions(directory: str, grader: dict, students: int, per_zip: int, weights: dict, seed: int) -> dict:
+    """
+    Creates the grading material folder and the brightspace zips of the benchmark inside directory,
+    returns how many students of each kind were generated
+    """
+    labs = list(grader['LAB_NAME_GRADING_SOFTWARE_INDEX'])
+    grading_material = os.path.join(directory, grader['GRADING_MATERIAL_LOCATION'])
+    os.makedirs(grading_material)
+    for lab, grading_software in grader['LAB_NAME_GRADING_SOFTWARE_INDEX'].items():
+        with open(os.path.join(grading_material, grading_software + '.py'), 'w') as file:
+            file.write(GRADING_SCRIPT.format(lab=lab))
+
+    kinds = submission_kinds(students, weights, seed)
+    for zip_index, start in enumerate(range(0, students, per_zip)):
+        zip_path = os.path.join(directory, f'benchmark submissions {zip_index + 1}.zip')
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for index in range(start, min(students, start + per_zip)):
+                kind, lab = kinds[index], labs[index % len(labs)]
+                first, last, student_id = f'First{index}', f'Last{index}', f'1{index:08d}'
+                folder = student_folder_name(index, first, last, student_id)
+                given_id = '100000000' if kind == 'id_mismatch' else student_id
+                code = f'__author__ = "{first} {last}"\n__student_number__ = "{given_id}"\n__team__ = "T-1"\n\n' + \
+                       SUBMISSION_BODIES[kind].format(lab=lab)
+                file_name = 'lab.py' if kind == 'wrong_file_name' else lab + '.py'
+                zip_file.writestr(f'{folder}/{file_name}', code)
+                zip_file.writestr(f'{folder}/attachment.pdf', b'%PDF' + b'0' * ATTACHMENT_BYTES)
+            zip_file.writestr(grader['INDEX_FILE_NAME'], '<html><body>brightspace download</body></html>')
+    return {kind: kinds.count(kind) for kind in weights}
+
+
+def run_grader(directory: str, grader_path: str, grader_args: list) -> tuple:
+    """
+    Runs the grader inside directory, returns its wall time and the time of each stage, taken from when the
+    grader prints that a zip starts and finishes grading
+    """
+    command = [sys.executable, os.path.basename(grader_path)] + grader_args
+    stages = {}
+    start = last_mark = time.perf_counter()
+    with subprocess.Popen(command, cwd=directory, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL, text=True, env=dict(os.environ, PYTHONUNBUFFERED='1')) as process:
+        batch = 0
+        for line in process.stdout:
+            now = time.perf_counter()
+            if line.startswith('Beginning grading folder'):
+                batch += 1
+                stages['start up' if batch == 1 else f'between zips {batch - 1}-{batch}'] = now - last_mark
+                last_mark = now
+            elif line.startswith('Done grading') and not line.startswith('Done grading all'):
+                stages[f'grading zip {batch}'] = now - last_mark
+                last_mark = now
+    end = time.perf_counter()
+    stages['finishing'] = end - last_mark
+    if process.returncode != 0:
+        raise RuntimeError(f'the grader exited with code {process.returncode}, run it in {directory} to see why')
+    return end - start, stages
+
+
+def count_grades(directory: str, grader: dict) -> int:
+    """Returns the number of grades the grader saved to its csv file"""
+    with open(os.path.join(directory, grader['SAVE_GRADES_TO']), encoding='utf-8') as file:
+        return len(list(csv.reader(file))) - 1
+
+
+def read_grader_report(directory: str, grader: dict) -> dict:
+    """
+    Returns the stages of the grader's run report (count, total, p50, p95 and max wall time, total CPU time),
+    empty for graders that do not save one
+    """
+    report_path = os.path.join(directory, grader.get('REPORT_FILE') or '')
+    if not grader.get('REPORT_FILE') or not os.path.isfile(report_path):
+        return {}
+    with open(report_path, encoding='utf-8') as file:
+        report = json.load(file)
+    return {name: {'count': stage['count'], **stage['wall'],
+                   'cpu': stage['cpu']['total'] + stage['child_cpu']['total']}
+            for name, stage in report['stages'].items()}
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    """Generates the submissions and grades them args.repeat times, returns the results of the fastest run"""
+    grader = read_grader_settings(args.grader)
+    weights = parse_mix(args.mix)
+    runs = []
+    for repeat in range(args.repeat):
+        directory = args.keep or tempfile.mkdtemp(prefix='grading_benchmark_')
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        try:
+            counts = generate_submissions(directory, grader, args.students, args.per_zip, weights, args.seed)
+            shutil.copyfile(args.grader, os.path.join(directory, os.path.basename(args.grader)))
+            wall_time, stages = run_grader(directory, args.grader, ['--jobs', str(args.jobs), '--no-cache'])
+            grades = count_grades(directory, grader)
+            if grades != args.students:
+                print(f'warning: {grades} grades saved for {args.students} students', file=sys.stderr)
+            runs.append({'wall_time': wall_time, 'stages': stages,
+                         'grader_stages': read_grader_report(directory, grader)})
+            print(f'run {repeat + 1}/{args.repeat}: {wall_time:.2f}s ({args.students / wall_time:.1f} students/s)')
+        finally:
+            if not args.keep:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    fastest = min(runs, key=lambda run: run['wall_time'])
+    return {'grader': os.path.abspath(args.grader), 'students': args.students, 'per_zip': args.per_zip,
+            'jobs': args.jobs, 'mix': counts, 'wall_times': [run['wall_time'] for run in runs],
+            'wall_time': fastest['wall_time'], 'students_per_second': args.students / fastest['wall_time'],
+            'stages': fastest['stages'], 'grader_stages': fastest['grader_stages']}
+
+
+def print_results(results: dict, baseline: dict = None):
+    """Prints the results of the fastest run, compared with baseline when one is given"""
+    print(f"\n{results['students']} students in zips of {results['per_zip']}, --jobs {results['jobs']}")
+    print('mix: ' + ', '.join(f'{kind} {count}' for kind, count in results['mix'].items()))
+    print(f"{'stage':<24}{'seconds':>10}{'baseline':>10}")
+    for stage, seconds in results['stages'].items():
+        baseline_seconds = baseline['stages'].get(stage) if baseline else None
+        baseline_text = f'{baseline_seconds:.2f}' if baseline_seconds is not None else ''
+        print(f'{stage:<24}{seconds:>10.2f}{baseline_text:>10}')
+    print(f"{'total':<24}{results['wall_time']:>10.2f}" +
+          (f"{baseline['wall_time']:>10.2f}" if baseline else ''))
+    print(f"students/second: {results['students_per_second']:.1f}")
+    if results['grader_stages']:
+        baseline_stages = baseline.get('grader_stages', {}) if baseline else {}
+        print(f"\nstages reported by the grader (seconds, summed over threads)")
+        print(f"{'stage':<26}{'count':>7}{'total':>9}{'p50':>9}{'p95':>9}{'max':>9}{'cpu':>9}{'baseline':>10}")
+        for name, stage in results['grader_stages'].items():
+            baseline_text = f"{baseline_stages[name]['total']:.3f}" if name in baseline_stages else ''
+            print(f"{name:<26}{stage['count']:>7}{stage['total']:>9.3f}{stage['p50']:>9.3f}{stage['p95']:>9.3f}"
+                  f"{stage['max']:>9.3f}{stage['cpu']:>9.3f}{baseline_text:>10}")
+    if baseline:
+        if (baseline['students'], baseline['per_zip'], baseline['mix']) != \
+                (results['students'], results['per_zip'], results['mix']):
+            print('warning: the baseline was measured on different submissions', file=sys.stderr)
+        print(f"baseline students/second: {baseline['students_per_second']:.1f} "
+              f"(x{results['students_per_second'] / baseline['students_per_second']:.2f})")
+
+
+def parse_arguments(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark run_grading_multiple_tests.py on generated submissions')
+    parser.add_argument('--students', type=int, default=100, help='number of students (default: %(default)s)')
+    parser.add_argument('--per-zip', type=int, default=200,
+                        help='students in each brightspace zip (default: %(default)s)')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='weight of each kind of submission (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=1, help='--jobs given to the grader (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs to do, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0, help='seed used to shuffle the submission kinds')
+    parser.add_argument('--grader', default=DEFAULT_GRADER, help='grading script to benchmark')
+    parser.add_argument('--keep', metavar='FOLDER', help='generate and grade in FOLDER and keep it afterwards')
+    parser.add_argument('--save-baseline', metavar='FILE', help='save the results as json to compare with later')
+    parser.add_argument('--baseline', metavar='FILE', help='compare the results with a saved baseline')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_arguments()
+    if args.keep:
+        args.keep = os.path.abspath(args.keep)
+    results = run_benchmark(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print(f'results saved to {args.save_baseline}')
+
+
+if __name__ == '__main__':
+    main()
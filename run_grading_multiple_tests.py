@@ -14,16 +14,47 @@ and the zip file directly downloaded from brightspace (THIS VERSION ALLOWS YOU T
 
 Any erroneous submissions with mismatching student IDs or infinite loops will be reported in the console
 as error to the user and will inform you of student name, ID and folder name
+
+Students can be graded in parallel with --jobs N, each student is graded in its own scratch workspace so the
+grading material folder is never modified. Submissions are read straight from the zip files, only the python
+files a student's code needs are written to their workspace. On Linux/macOS student code is run by forking a pre-warmed python process
+(the forkserver) instead of starting a new interpreter every time.
 """
 
+import argparse
+import ast
+import builtins
+import contextlib
 import csv
+import errno
+import functools
+import hashlib
+import importlib.util
+import io
+import json
+import marshal
 import os
+import random
+import select
 import shutil
 import subprocess
 import sys
+import tempfile
 import zipfile
 import traceback
 import signal
+import sqlite3
+import statistics
+import threading
+import time
+import types
+import warnings
+from concurrent.futures import ThreadPoolExecutor, wait as wait_for_futures
+
+try:
+    import resource
+except ImportError:  # Windows, student processes run without resource limits
+    resource = None
 
 __author__ = "Boaz Aharony"
 __copyright__ = "Copyright 2023, Boaz Aharony"
@@ -42,88 +73,130 @@ SCORE_CODE = 'round(passes / result.testsRun * 4, 2)'  # Code used to calculate
 GRADING_MATERIAL_LOCATION = 'grading material'  # The name of the folder that contains the grading script
 FEEDBACK_ZIP_FOLDER_NAME = 'feedback for brightspace'  # Name of folder to which student feedback will be zipped into, DO NOT ADD .zip
 ADD_NAME_TO_CSV = False  # Set to True if you want a name column to show up on the CSV
+REFERENCE_SOLUTION_LOCATION = 'reference solution'  # folder with a correct solution of each lab (e.g. student_age_list.py) used to set the timeouts, None always uses TIMEOUT
+LAB_TEST_SHARDS = {}  # lab name -> processes its tests are split across for each student, e.g. {'student_age_list': 4} (only for tests loaded with unittest.TestLoader that don't share files, SCORE_CODE may only use result and passes)
+LAB_RESOURCE_LIMITS = {}  # lab name -> limits replacing those of RESOURCE_LIMITS for that lab, e.g. {'student_age_list': {'memory_mb': 2048}}
 ########################## CHANGE EVERY LAB ###########################################################################
 
 ########################## GENERAL CONDITIONS ###########################################################################
 TEAM_NAME_CHECK = True
 FIX_NAME_ORDER = True  # make program print first name then last name onto csv and student feedback when set to true
 PRINT_ALL_STUDENTS = False  # Prints student that it is currently grading (use for debugging)
-TIMEOUT = 2  # set for limiting maximum runtime of a students code check (in seconds)
+TIMEOUT = 2  # set for limiting maximum runtime of a students code check (in seconds), used for labs without a reference solution
+TIMEOUT_CALIBRATION_RUNS = 3  # times each reference solution is run to measure how long a lab takes
+TIMEOUT_MULTIPLIER = 10  # calibrated timeout = slowest reference run times this (rounded up to 0.5, 1, 2, 5, 10, 20...)
+MIN_TIMEOUT = 0.5  # calibrated timeouts are never shorter than this (in seconds)
+MAX_TIMEOUT = 60  # calibrated timeouts are never longer than this, reference runs are stopped after it (in seconds)
+JOBS = 1  # number of students graded at once, can be overridden with --jobs N
+USE_FORKSERVER = True  # fork student runs from a pre-warmed python process (Linux/macOS only, ignored on Windows)
+FORKSERVER_PRELOAD_MODULES = ['unittest']  # modules imported once by the forkserver, add heavy modules the tests use
+PRELOAD_GRADING_IMPORTS = True  # the forkserver also imports the installed modules the grading scripts import
+FORKSERVER_MAX_RUNS = 500  # the forkserver is replaced by a fresh one after this many student runs
+PRESCREEN_SUBMISSIONS = True  # read syntax errors and name/ID problems straight from the student's file when that is certain, without running it
+RESOURCE_LIMITS = {'memory_mb': 1024,  # address space of a student process
+                   'cpu_seconds': 60,  # CPU time of a student process
+                   'processes': 50,  # processes/threads a student process may start
+                   'file_size_mb': 50,  # largest file (output included) a student process may write
+                   'output_mb': 10}  # output a student process may print before it is stopped, None turns a limit off (only output_mb on Windows)
+MAX_OUTPUT_KB = 64  # output of a student process kept for its feedback, only the start and end of longer output are kept
+SINGLE_LAUNCH_GRADING = True  # check name/ID and grade in one student process instead of two (TIMEOUT for each part)
+RESULT_CACHE_LOCATION = 'grading cache'  # folder keeping results of graded files between runs, None turns it off
+RESULT_CACHE_MAX_MB = 200  # least recently used results are removed once the cache is bigger than this
+JOURNAL_FILE = 'grading journal.jsonl'  # every graded student is saved here as soon as it is done (used by --resume)
+SCRATCH_LOCATION = None  # folder for student workspaces, None uses /dev/shm (kept in RAM) when available
+REPORT_FILE = 'grading report.json'  # time spent in each stage of the run (per student and overall), None turns it off
+GRADE_STATISTICS_FILE = 'grade statistics.json'  # score statistics of each lab for the run and each zip, None turns it off
+GRADE_HISTOGRAM_BINS = 10  # bars of the score histogram of each lab in GRADE_STATISTICS_FILE
+TEST_MATRIX_FILE = 'test matrix.json'  # which tests each graded student failed (see TestMatrix), None turns it off
+SIMILARITY_REPORT_FILE = 'similarity report.json'  # pairs and groups of alike submissions of each lab, None turns the check off
+SIMILARITY_THRESHOLD = 0.8  # share of their code structure two submissions must have in common to be reported (0 to 1)
+RESULTS_DATABASE = 'grading results.sqlite'  # every run adds its students here (kept across labs and terms), the CSV is exported from it, None turns it off
+TERM = ''  # e.g. 'Winter 2024', saved with every run in RESULTS_DATABASE so results of different terms can be told apart
 ########################## GENERAL CONDITIONS ###########################################################################
 
 # Constants
 INDEX_FILE_NAME = 'index.html'
+DO_NOT_UPLOAD_PREFIX = 'DO_NOT_UPLOAD_'
+INPUT_EXIT_CODE = 86  # exit code of a student process that tried to read input
+JOURNAL_FIELDS = ('folder', 'name', 'student_id', 'score', 'feedback', 'file_to_grade', 'outcome', 'duplicate_of',
+                  'seconds', 'tests', 'given_id', 'given_author')
+FAILED_TEST_OUTCOMES = ('fail', 'error', 'unexpected_success')  # test outcomes counted as failed in the test matrix
+HARDEST_TESTS_PRINTED = 3  # tests with the most failures printed for each lab at the end of the run
+SIMILARITY_SHINGLE_NODES = 10  # syntax tree nodes in each piece of code compared between submissions
+SIMILARITY_MIN_SHINGLES = 10  # shorter submissions are not compared, there are few ways to write them
+SIMILARITY_COMMON_SHARE = 0.5  # pieces in more than this share of a lab's submissions (starter code...) are ignored
+SIMILARITY_COMMON_MIN_SUBMISSIONS = 20  # ... when the lab has at least this many submissions
+MINHASH_BANDS = 16  # the minhash signature of a submission is MINHASH_BANDS * MINHASH_ROWS hashes, submissions
+MINHASH_ROWS = 4  # sharing all the hashes of a band are compared (misses ~1% of pairs 70% alike, almost none above 80%)
+MINHASH_PRIME = (1 << 61) - 1
+SIMILAR_PAIRS_PRINTED = 10  # most alike pairs printed at the end of the run, the others are in SIMILARITY_REPORT_FILE
+# settings each lab of a --config file may set, the others come from this file
+LAB_CONFIG_SETTINGS = ('LAB_NAME_GRADING_SOFTWARE_INDEX', 'SAVE_GRADES_TO', 'GRADES_CSV_HEADER', 'SCORE_CODE',
+                       'GRADING_MATERIAL_LOCATION', 'FEEDBACK_ZIP_FOLDER_NAME', 'ADD_NAME_TO_CSV',
+                       'REFERENCE_SOLUTION_LOCATION', 'LAB_TEST_SHARDS', 'LAB_RESOURCE_LIMITS', 'TEAM_NAME_CHECK',
+                       'TIMEOUT', 'RESULTS_DATABASE', 'TERM')
+RESULT_CACHE_FORMAT = 2  # changed whenever the entries saved in the result cache change
+PHASE_POLL_INTERVAL = 0.01  # how often a single launch run checks whether the name/ID part is done (in seconds)
+OUTPUT_POLL_INTERVAL = 0.05  # how often the output size of a forked student process is checked (in seconds)
+STOP_POLL_INTERVAL = 0.1  # how often a running student process is checked for the run stopping (in seconds)
 
 # save original print streams
 original_stderr = sys.stderr
 
-
-def add_feedback_text(student_folder: str, specific_feedback: str, file_name: str):
-    """move feedback to top of student's submitted file
+# state needed by handle_signal to clean up
+original_dir = os.getcwd()
+original_grading_material_files = []
+feedback_zips = []
+batch_loader = None
+feedback_writer = None
+grading_pool = None
+shard_pool = None
+workspace_root = None
+result_cache = None
+results_database = None
+grading_material_hashes = {}  # lab name -> hash of the grading material it is graded with, see material_hash
+lab_timeouts = {}  # lab name -> (name/ID check timeout, grading timeout) calibrated from the reference solution
+user_process_limit = None  # RLIMIT_NPROC of student processes (see grading_run_processes), None if it can't be set
+grading_scripts = {}  # grading software name (with .py) -> its source, read once by grading_script
+compiled_code = {}  # code run in student processes -> (id, marshalled code object), see compile_student_code
+compiled_code_lock = threading.Lock()
+preload_modules = list(FORKSERVER_PRELOAD_MODULES)  # imported once by every forkserver, see prepare_grading_scripts
+job_server = None  # (read fd, write fd) of the pipe holding the job tokens shared by every lab of a --config run
+
+# set once the run is stopping (ctrl+C or a crash), results computed after it are not cached
+grading_stopped = threading.Event()
+
+# every grading thread gets a forkserver of its own (and knows if one of its student processes was killed)
+thread_state = threading.local()
+fork_servers = []
+fork_servers_lock = threading.Lock()
+
+# compile warnings are caught by changing the (process wide) warning filters, one pre-screen at a time
+prescreen_lock = threading.Lock()
+
+
+def add_feedback_text(student: dict, specific_feedback: str, file_name: str, file_contents: bytes) -> tuple:
+    """move feedback to top of student's submitted file, returns the name and contents of the file with feedback
     """
-
-    # Find student file
-    src_file = os.path.join(os.getcwd(), student_folder + '\\' + file_name + '.py')
+    student_folder = student['folder']
 
     # add # to first line and after every \n
     specific_feedback_for_code = '################### FEEDBACK ############################\n' + \
                                  '# ' + specific_feedback.replace('\n', '\n# ') + \
                                  '\n################### FEEDBACK ############################\n\n'
-    # read python file
-    cannot_read_original = False
+    # check the python file can be read
     try:
-        with open(src_file, 'r', encoding='utf-8') as file:
-            file_contents = file.read()
+        file_contents.decode('utf-8')
     except Exception as err:
-        cannot_read_original = True
         print(f"An error occurred: {err}")
         print(
-            'Review student (odd file encoding format -> feedback saved to seperate feedback.txt file in student\'s folder): ' + name + ', ID#: ' + student_id + ', Folder name:\'' + folder + '\'\n',
+            'Review student (odd file encoding format -> feedback saved to seperate feedback.txt file in student\'s folder): ' + student['name'] + ', ID#: ' + student['student_id'] + ', Folder name:\'' + student_folder + '\'\n',
             file=original_stderr)
-    if not cannot_read_original:
-        # Add feedback
-        new_file_contents = specific_feedback_for_code + file_contents
-
-        # Write to file
-        file = open(src_file, 'w')
-        file.write(new_file_contents)
-        file.close()
-        rename_file(src_file, 'FEEDBACK_' + file_name + '.py')
-
-    else:
-        os.remove(src_file)
-        src_file = os.path.abspath(os.getcwd()) + '\\' + student_folder + '\\' + 'feedback.txt'
-        file = open(src_file, 'w')
         new_file_contents = 'ERROR WRITING TO ORIGINAL CODE, FEEDBACK BELOW:\n\n' + specific_feedback
-        file.write(new_file_contents)
-        file.close()
+        return 'feedback.txt', new_file_contents.encode('utf-8')
 
-
-def rename_file(file_path, new_name) -> bool:
-    """
-    Rename the file at the given file path with the new name.
-
-    Args:
-    file_path (str): The file path.
-    new_name (str): The new name for the file.
-
-    Returns:
-    bool: True if the file was renamed successfully, False otherwise.
-    """
-    try:
-        # Get the directory and the current name of the file
-        directory = os.path.dirname(file_path)
-
-        # Generate the new file path with the new name
-        new_path = os.path.join(directory, new_name)
-
-        # Rename the file
-        os.rename(file_path, new_path)
-
-        return True
-    except Exception as e:
-        print("Error renaming file:", e)
-        return False
+    # Add feedback
+    return 'FEEDBACK_' + file_name + '.py', specific_feedback_for_code.encode('utf-8') + file_contents
 
 
 def parse_name_and_student_id(folder_name: str, fix_order: bool) -> tuple:
@@ -159,18 +232,1170 @@ def fix_name_order(name_part: str) -> str:
     return name_part
 
 
-def save_grade_to_CSV(grades: list, fieldnames: list):
-    """Saves list of grades with fieldnames to a csv file"""
-    with open(SAVE_GRADES_TO, 'w', encoding='UTF8', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(grades)
+class GradesCSV:
+    """
+    CSV file of grades in brightspace format, a row is written (and flushed) as soon as a student is graded, so the
+    file holds every student graded so far if the run stops (a run continued with --resume writes them all again)
+    """
+
+    def __init__(self, path: str, fieldnames: list):
+        self.file = open(path, 'w', encoding='UTF8', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames)
+        self.writer.writeheader()
+        self.file.flush()
+        self.rows = 0
+
+    def add(self, grade: dict):
+        self.writer.writerow(grade)
+        self.file.flush()
+        self.rows += 1
+
+    def close(self):
+        self.file.close()
+
+
+class ResultsDatabase:
+    """
+    SQLite database keeping every student of every run (one row per student in results, one row per run in runs),
+    so questions across labs and terms are a query instead of a rerun, e.g. students that timed out in any lab:
+    SELECT term, grade_item, OrgDefinedId, lab FROM results JOIN runs USING (run_id) WHERE outcome = 'infinite_loop'
+    A run resumed with --resume keeps the run_id it had, see add_student.
+    Used from the main thread only.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, started TEXT, term TEXT, grade_item TEXT,
+                                     lab_folder TEXT, csv_file TEXT);
+    CREATE TABLE IF NOT EXISTS results (run_id INTEGER REFERENCES runs, zip TEXT, folder TEXT, OrgDefinedId TEXT,
+                                        name TEXT, lab TEXT, score, outcome TEXT, duplicate_of TEXT,
+                                        seconds REAL, feedback_sha256 TEXT, given_id TEXT, given_author TEXT);
+    CREATE INDEX IF NOT EXISTS results_by_id ON results (OrgDefinedId);
+    CREATE INDEX IF NOT EXISTS results_by_lab ON results (lab);
+    CREATE INDEX IF NOT EXISTS results_by_run ON results (run_id);
+    """  # score has no type so it is kept exactly as SCORE_CODE returned it (0 stays 0, 4.0 stays 4.0)
+
+    def __init__(self, path: str, run_id: int = None):
+        """Starts a new run, or carries on with run_id (the run that was interrupted)"""
+        self.connection = sqlite3.connect(path, timeout=60)  # the labs of a --config run share one database
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(self.SCHEMA)
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(results)')]
+        for column in ('given_id', 'given_author'):  # databases made before they were saved
+            if column not in columns:
+                self.connection.execute(f'ALTER TABLE results ADD COLUMN {column} TEXT')
+        if run_id is not None and self.connection.execute('SELECT 1 FROM runs WHERE run_id = ?', (run_id,)).fetchone():
+            self.run_id = run_id
+            return
+        self.run_id = self.connection.execute(
+            'INSERT INTO runs (started, term, grade_item, lab_folder, csv_file) VALUES (?, ?, ?, ?, ?)',
+            (time.strftime('%Y-%m-%d %H:%M:%S'), TERM, GRADES_CSV_HEADER, os.getcwd(), SAVE_GRADES_TO)).lastrowid
+        self.connection.commit()
+
+    def add_student(self, zip_name: str, student: dict):
+        """
+        Adds a student of this run, saved once commit is called. Students graded before the run was interrupted
+        (journaled) are only added if they are not in it yet, rows are saved once per zip so the last zip
+        of an interrupted run may be missing some
+        """
+        if student.get('journaled') and self.connection.execute(
+                'SELECT 1 FROM results WHERE run_id = ? AND zip = ? AND folder = ?',
+                (self.run_id, zip_name, student['folder'])).fetchone():
+            return
+        outcome = student['outcome']
+        if outcome == 'graded' and student['score'] == -1:  # the grading script failed on this student
+            outcome = 'grading_error'
+        feedback = student.get('feedback')
+        self.connection.execute(
+            'INSERT INTO results (run_id, zip, folder, OrgDefinedId, name, lab, score, outcome, duplicate_of, seconds, '
+            'feedback_sha256, given_id, given_author) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (self.run_id, zip_name, student['folder'], student['student_id'], student['name'],
+             student.get('file_to_grade'), student.get('score'), outcome, student.get('duplicate_of'),
+             student.get('seconds'),
+             None if feedback is None else hashlib.sha256(feedback.encode('utf-8')).hexdigest(),
+             student.get('given_id'), student.get('given_author')))
+
+    def commit(self):
+        self.connection.commit()
+
+    def export_grades_csv(self, path: str, run_id: int = None):
+        """
+        Writes the grades CSV of a run (this one by default) from its results, in the format of GradesCSV, students
+        with more than one file are left out for the marker like in the CSV of the run
+        """
+        run_id = self.run_id if run_id is None else run_id
+        grade_item, = self.connection.execute('SELECT grade_item FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+        grades = GradesCSV(path, ['OrgDefinedId', grade_item, 'End-of-Line Indicator'] +
+                           (['Name'] if ADD_NAME_TO_CSV else []))
+        for student_id, name, score in self.connection.execute(
+                "SELECT OrgDefinedId, name, score FROM results WHERE run_id = ? AND outcome != 'more_than_one_file' "
+                "ORDER BY rowid", (run_id,)):
+            grades.add(dict({'OrgDefinedId': student_id, grade_item: score, 'End-of-Line Indicator': '#'},
+                            **({'Name': name} if ADD_NAME_TO_CSV else {})))
+        grades.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class TestMatrix:
+    """
+    Which tests of a lab every graded student ran and failed. The matrix is kept by test: a column is a bitset
+    (a python int) with bit i set for the i-th student, so the questions about the whole class are a few integer
+    operations per test. Load a saved one with load_test_matrices to query it after the run.
+    """
+
+    def __init__(self, students: list = None, tests: list = None, failed: list = None, ran: list = None):
+        self.students = students or []  # student ID of each row
+        self.tests = tests or []  # test ID of each column
+        self.failed = failed or []  # bitset of the students that failed each test
+        self.ran = ran or []  # bitset of the students that ran each test (not skipped)
+        self.columns = {test: column for column, test in enumerate(self.tests)}
+
+    def add(self, student_id: str, tests: dict):
+        """Adds a student's row from their test outcomes (test ID -> outcome, see GRADING_RESULT_CODE)"""
+        row = 1 << len(self.students)
+        self.students.append(student_id)
+        for test, outcome in tests.items():
+            if test not in self.columns:
+                self.columns[test] = len(self.tests)
+                self.tests.append(test)
+                self.failed.append(0)
+                self.ran.append(0)
+            column = self.columns[test]
+            if outcome != 'skip':
+                self.ran[column] |= row
+            if outcome in FAILED_TEST_OUTCOMES:
+                self.failed[column] |= row
+
+    def hardest_tests(self) -> list:
+        """Returns (test, students that failed it, students that ran it) of every test, most failed first"""
+        counts = [(test, count_bits(self.failed[column]), count_bits(self.ran[column]))
+                  for column, test in enumerate(self.tests)]
+        return sorted(counts, key=lambda count: (-count[1] / max(count[2], 1), count[0]))
+
+    def failed_together(self) -> list:
+        """Returns (test, other test, students that failed both) of every pair failed together, most often first"""
+        pairs = []
+        for column, test in enumerate(self.tests):
+            for other_column in range(column + 1, len(self.tests)):
+                both = count_bits(self.failed[column] & self.failed[other_column])
+                if both:
+                    pairs.append((test, self.tests[other_column], both))
+        return sorted(pairs, key=lambda pair: -pair[2])
+
+    def failed_tests(self, student_id: str) -> list:
+        """Returns the tests failed by a student (their last row if they were graded more than once)"""
+        row = 1 << (len(self.students) - 1 - self.students[::-1].index(student_id))
+        return [test for column, test in enumerate(self.tests) if self.failed[column] & row]
+
+    def to_json(self) -> dict:
+        """Returns the matrix with its columns as hex strings"""
+        return {'students': self.students, 'tests': self.tests, 'failed': [format(bits, 'x') for bits in self.failed],
+                'ran': [format(bits, 'x') for bits in self.ran]}
+
+    @classmethod
+    def from_json(cls, saved: dict):
+        return cls(saved['students'], saved['tests'], [int(bits, 16) for bits in saved['failed']],
+                   [int(bits, 16) for bits in saved['ran']])
+
+
+class SimilarityIndex:
+    """
+    Finds alike submissions of each lab without comparing every pair. Each submission becomes the set of hashes
+    of its pieces of SIMILARITY_SHINGLE_NODES syntax tree nodes (names, comments, docstrings, the feedback added
+    to it and the __author__ lines left out, so renaming or reformatting changes nothing). A minhash signature
+    of the set is cut in MINHASH_BANDS bands, and only submissions sharing a whole band are compared, which
+    finds the pairs above SIMILARITY_THRESHOLD in about linear time.
+    """
+
+    def __init__(self):
+        self.submissions = []  # dict of zip, student_id, name, folder, lab, shingles of every comparable submission
+        self.students = {}  # student ID -> folder of every student of the run
+        self.given_ids = []  # (student, ID in their file) of students whose file has someone else's ID
+        generator = random.Random(0)
+        self.hash_functions = [(generator.randrange(1, MINHASH_PRIME), generator.randrange(MINHASH_PRIME))
+                               for _ in range(MINHASH_BANDS * MINHASH_ROWS)]
+
+    def add(self, zip_name: str, student: dict):
+        """Adds a graded student, their file is compared if it was run as one of the labs"""
+        self.students.setdefault(student['student_id'], student['folder'])
+        if student['outcome'] == 'id_mismatch':
+            self.given_ids.append((student, student['given_id']))
+        if student['outcome'] in ('more_than_one_file', 'wrong_file_name', 'syntax_error'):
+            return
+        shingles = code_shingles(student['py_sources'][student['file_to_grade'] + '.py'])
+        if shingles:
+            self.submissions.append({'zip': zip_name, 'student_id': student['student_id'], 'name': student['name'],
+                                     'folder': student['folder'], 'lab': student['file_to_grade'],
+                                     'shingles': shingles})
+
+    def report(self) -> dict:
+        """Returns the alike pairs (most alike first) and groups of each lab, and the files with another's ID"""
+        labs = {}
+        for submission in self.submissions:
+            labs.setdefault(submission['lab'], []).append(submission)
+        return {'labs': {lab_name: self.lab_report(submissions) for lab_name, submissions in labs.items()},
+                'id_of_other_student': [{'student_id': student['student_id'], 'name': student['name'],
+                                         'folder': student['folder'], 'id_in_file': given_id,
+                                         'folder_of_id': self.students[given_id]}
+                                        for student, given_id in self.given_ids if given_id in self.students]}
+
+    def lab_report(self, submissions: list) -> dict:
+        """Returns the alike pairs and groups among the submissions of one lab"""
+        # pieces most submissions have (starter code, the usual way to write a loop...) say nothing of copying
+        if len(submissions) >= SIMILARITY_COMMON_MIN_SUBMISSIONS:
+            counts = {}
+            for submission in submissions:
+                for shingle in submission['shingles']:
+                    counts[shingle] = counts.get(shingle, 0) + 1
+            common = {shingle for shingle, count in counts.items() if count > SIMILARITY_COMMON_SHARE * len(submissions)}
+            submissions = [dict(submission, shingles=submission['shingles'] - common) for submission in submissions]
+        submissions = [submission for submission in submissions
+                       if len(submission['shingles']) >= SIMILARITY_MIN_SHINGLES]
+
+        candidates = set()
+        buckets = {}
+        for index, submission in enumerate(submissions):
+            signature = self.minhash(submission['shingles'])
+            for band in range(MINHASH_BANDS):
+                bucket = buckets.setdefault((band, tuple(signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS])),
+                                            [])
+                candidates.update((other, index) for other in bucket)
+                bucket.append(index)
+
+        pairs = []
+        for first, second in candidates:  # the signatures only pick the pairs to compare, the sets decide
+            first_shingles, second_shingles = submissions[first]['shingles'], submissions[second]['shingles']
+            similarity = len(first_shingles & second_shingles) / len(first_shingles | second_shingles)
+            if similarity >= SIMILARITY_THRESHOLD:
+                pairs.append((round(similarity, 3), first, second))
+        pairs.sort(key=lambda pair: (-pair[0], pair[1], pair[2]))
+
+        def described(index: int) -> dict:
+            return {field: submissions[index][field] for field in ('student_id', 'name', 'folder', 'zip')}
+
+        return {'pairs': [{'similarity': similarity, 'students': [described(first), described(second)]}
+                          for similarity, first, second in pairs],
+                'groups': [[described(index) for index in group] for group in alike_groups(pairs)]}
+
+    def minhash(self, shingles: set) -> list:
+        """Returns the smallest value of each hash function over the set, alike sets share many of them"""
+        return [min([(a * shingle + b) % MINHASH_PRIME for shingle in shingles]) for a, b in self.hash_functions]
+
+
+def code_shingles(source: bytes) -> set:
+    """
+    Returns the hashes of every SIMILARITY_SHINGLE_NODES nodes in a row of the syntax tree of source, an empty
+    set if it can't be parsed
+    """
+    try:
+        try:
+            tree = ast.parse(source)
+        except (SyntaxError, ValueError):  # not utf-8 without saying so, read like add_feedback_text can't
+            tree = ast.parse(source.decode('latin-1'))
+        nodes = list(normalized_nodes(tree))
+    except (SyntaxError, ValueError, RecursionError):
+        return set()
+    return {hash(tuple(nodes[start:start + SIMILARITY_SHINGLE_NODES])) & MINHASH_PRIME
+            for start in range(len(nodes) - SIMILARITY_SHINGLE_NODES + 1)}
 
 
-def get_id_and_author(lab_name: str,check_team=False) -> tuple:
-    """Returns the current name and id of the lab, 'syntaxError' if the file can't run
-    and 'TimeoutExpired' if the file takes too long to load
+def normalized_nodes(node: ast.AST):
+    """
+    Yields the syntax tree in source order as node types (and the type of constants), leaving out every name,
+    docstrings and the __author__/__student_number__/__team__ lines that differ between all students
     """
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, ast.Expr) and isinstance(child.value, ast.Constant) and \
+                isinstance(child.value.value, str):
+            continue
+        if isinstance(child, ast.Assign) and any(isinstance(target, ast.Name) and target.id.startswith('__')
+                                                 for target in child.targets):
+            continue
+        yield type(child).__name__
+        if isinstance(child, ast.Constant):
+            yield type(child.value).__name__
+        yield from normalized_nodes(child)
+
+
+def alike_groups(pairs: list) -> list:
+    """Returns the groups of submissions linked by alike pairs (similarity, index, index), largest first"""
+    parents = {}
+
+    def root(index: int) -> int:
+        while parents.setdefault(index, index) != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    for _, first, second in pairs:
+        parents[root(first)] = root(second)
+    groups = {}
+    for index in parents:
+        groups.setdefault(root(index), []).append(index)
+    return sorted((sorted(group) for group in groups.values()), key=lambda group: (-len(group), group))
+
+
+def print_similarity(report: dict):
+    """Prints the most alike submissions and the files with the ID of another student"""
+    print('-------similar submissions------')
+    pairs = sorted(((pair['similarity'], lab_name, pair['students']) for lab_name, lab_report in
+                    report['labs'].items() for pair in lab_report['pairs']), key=lambda pair: -pair[0])
+    for similarity, lab_name, (first, second) in pairs[:SIMILAR_PAIRS_PRINTED]:
+        print(f"{lab_name}: {first['name']} ({first['student_id']}) and {second['name']} ({second['student_id']}) "
+              f"are {similarity:.0%} alike")
+    groups = sum(len(lab_report['groups']) for lab_report in report['labs'].values())
+    print(f"{len(pairs)} alike pairs in {groups} groups")
+    for other_id in report['id_of_other_student']:
+        print(f"{other_id['name']} ({other_id['student_id']}) has the ID of the student in folder "
+              f"'{other_id['folder_of_id']}' in their file")
+
+
+def count_bits(bits: int) -> int:
+    """Returns the number of set bits (students) of a bitset"""
+    return bin(bits).count('1')
+
+
+def save_test_matrices(test_matrices: dict, path: str):
+    """Saves the test matrix of each lab, with its hardest tests and the tests most often failed together"""
+    saved = {lab_name: dict(test_matrix.to_json(),
+                            hardest=test_matrix.hardest_tests()[:10],
+                            failed_together=test_matrix.failed_together()[:10])
+             for lab_name, test_matrix in test_matrices.items()}
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(saved, file)
+
+
+def load_test_matrices(path: str) -> dict:
+    """Returns the test matrix of each lab saved by save_test_matrices"""
+    with open(path, encoding='utf-8') as file:
+        return {lab_name: TestMatrix.from_json(saved) for lab_name, saved in json.load(file).items()}
+
+
+class RunReport:
+    """
+    Wall and CPU time of every stage of the run, per student (or zip) and aggregated as p50, p95 and max.
+    CPU time is the time of the thread running the stage, plus the CPU time of student code it ran
+    when that is known (runs of the forkserver). Thread safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+        self.settings = {}  # settings chosen during the run that are worth keeping with it (e.g. timeouts)
+        self.run_start = time.perf_counter()
+        self.active = threading.local()  # stages currently running in each thread
+
+    @contextlib.contextmanager
+    def stage(self, name: str, subject: str = None):
+        """Times the code inside the with block as stage name of subject (a student folder or zip name)"""
+        record = {'stage': name, 'subject': subject, 'thread': threading.current_thread().name,
+                  'child_cpu': 0.0, 'child_max_rss': 0}
+        stack = self.active.__dict__.setdefault('stack', [])
+        stack.append(record)
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+        finally:
+            record['start'] = wall_start - self.run_start
+            record['wall'] = time.perf_counter() - wall_start
+            record['cpu'] = time.thread_time() - cpu_start
+            stack.pop()
+            with self.lock:
+                self.records.append(record)
+
+    def add_child_usage(self, cpu_time: float, max_rss: int):
+        """Adds the resources used by a finished student process to the stage running in this thread"""
+        stack = getattr(self.active, 'stack', None)
+        if stack:
+            stack[-1]['child_cpu'] += cpu_time
+            stack[-1]['child_max_rss'] = max(stack[-1]['child_max_rss'], max_rss)
+
+    def summary(self) -> dict:
+        """Returns the stages aggregated over the run and per subject"""
+        with self.lock:
+            records = list(self.records)
+        stages, subjects = {}, {}
+        for record in records:
+            stages.setdefault(record['stage'], []).append(record)
+            if record['subject'] is not None:
+                subject = subjects.setdefault(record['subject'], {})
+                times = subject.setdefault(record['stage'], {'wall': 0.0, 'cpu': 0.0, 'child_cpu': 0.0})
+                for measure in times:
+                    times[measure] += record[measure]
+        return {'wall_time': time.perf_counter() - self.run_start, 'settings': self.settings,
+                'stages': {name: {'count': len(stage_records),
+                                  **{measure: aggregate([record[measure] for record in stage_records])
+                                     for measure in ('wall', 'cpu', 'child_cpu')},
+                                  'child_max_rss': max(record['child_max_rss'] for record in stage_records)}
+                           for name, stage_records in stages.items()},
+                'subjects': subjects}
+
+    def save(self, path: str):
+        """Saves the report as json"""
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.summary(), file, indent=1)
+
+    def save_trace(self, path: str):
+        """Saves every stage as a chrome trace (open it in chrome://tracing or ui.perfetto.dev)"""
+        with self.lock:
+            records = list(self.records)
+        thread_ids = {}
+        events = []
+        for record in records:
+            thread_id = thread_ids.setdefault(record['thread'], len(thread_ids))
+            events.append({'name': record['stage'], 'ph': 'X', 'pid': 1, 'tid': thread_id,
+                           'ts': round(record['start'] * 1e6), 'dur': round(record['wall'] * 1e6),
+                           'args': {'subject': record['subject'], 'cpu': record['cpu'],
+                                    'child_cpu': record['child_cpu']}})
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': thread_id, 'args': {'name': thread_name}}
+                   for thread_name, thread_id in thread_ids.items()]
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'traceEvents': events}, file)
+
+
+def aggregate(values: list) -> dict:
+    """Returns the total, p50, p95 and max of a list of times"""
+    values = sorted(values)
+    return {'total': sum(values), 'p50': percentile(values, 50), 'p95': percentile(values, 95), 'max': values[-1]}
+
+
+def percentile(sorted_values: list, percent: float) -> float:
+    """Nearest rank percentile of a sorted list"""
+    rank = max(int(-(-len(sorted_values) * percent // 100)), 1)  # ceil without importing math
+    return sorted_values[rank - 1]
+
+
+run_report = RunReport()
+
+
+class InputInCode(Exception):
+    """Raised by run_student_code when the student's code tried to read input (input() or sys.stdin)"""
+
+
+# run first in every student process: stdin is empty, so reading it stops the process right away
+STDIN_GUARD_CODE = f"""import builtins, io, os, sys
+original_input = builtins.input
+def exit_on_read(*args, **kwargs):
+    os._exit({INPUT_EXIT_CODE})
+class StdinGuard(io.TextIOBase):
+    read = readline = readlines = exit_on_read
+    def readable(self):
+        return True
+def read_input(*args, **kwargs):
+    if isinstance(sys.stdin, StdinGuard):  # would wait on the empty stdin of the student process
+        exit_on_read()
+    return original_input(*args, **kwargs)  # a grading script gave sys.stdin the input to read
+builtins.input = read_input
+sys.stdin = StdinGuard()
+"""
+
+# ctrl+C kills a student process instead of raising KeyboardInterrupt in it (which its code could report as a
+# result), so runs the grader was stopped in are told apart by their exit code, see run_student_code
+SIGINT_CODE = 'import _signal\n_signal.signal(_signal.SIGINT, _signal.SIG_DFL)\n'
+
+
+class GradingStopped(Exception):
+    """Raised by run_student_code once the run is stopping (grading_stopped), the student is left ungraded"""
+
+
+class ResourceLimitExceeded(Exception):
+    """Raised by run_student_code when the student's code ran into one of its resource limits (see RESOURCE_LIMITS)"""
+
+    def __init__(self, limit: str):
+        super().__init__(limit)
+        self.limit = limit  # the RESOURCE_LIMITS key of the limit
+
+
+RESOURCE_LIMIT_DESCRIPTIONS = {'memory_mb': 'memory', 'cpu_seconds': 'CPU time', 'processes': 'process count',
+                               'file_size_mb': 'file size', 'output_mb': 'printed output'}
+
+
+def resource_limits_of(lab_name: str) -> dict:
+    """Returns the resource limits of a lab's student processes, RESOURCE_LIMITS with the lab's LAB_RESOURCE_LIMITS"""
+    return dict(RESOURCE_LIMITS, **LAB_RESOURCE_LIMITS.get(lab_name, {}))
+
+
+def count_user_processes():
+    """Returns the number of processes/threads the current user is running (what RLIMIT_NPROC counts on Linux),
+    None if it can't be counted
+    """
+    try:
+        pids = [name for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return None
+    count = 0
+    for pid in pids:
+        try:
+            if os.stat(os.path.join('/proc', pid)).st_uid == os.getuid():
+                count += len(os.listdir(os.path.join('/proc', pid, 'task')))
+        except OSError:  # the process ended
+            pass
+    return count
+
+
+def grading_run_processes(jobs: int, lab_settings: dict = None) -> int:
+    """
+    Most processes/threads (what RLIMIT_NPROC counts) a grading run of --jobs jobs has at once: the main, batch
+    loader and feedback writer threads, and for each of the jobs * (most test shards of a lab) students processes
+    running at once the thread running it, its forkserver (or two output reader threads), the student process and
+    the processes it may start. lab_settings are the settings of a --config lab, the others come from this file.
+    """
+    lab_settings = lab_settings or {}
+    lab_names = lab_settings.get('LAB_NAME_GRADING_SOFTWARE_INDEX', LAB_NAME_GRADING_SOFTWARE_INDEX)
+    lab_test_shards = lab_settings.get('LAB_TEST_SHARDS', LAB_TEST_SHARDS)
+    lab_resource_limits = lab_settings.get('LAB_RESOURCE_LIMITS', LAB_RESOURCE_LIMITS)
+    shards = max([lab_test_shards.get(lab_name, 1) for lab_name in lab_names], default=1)
+    processes = max([dict(RESOURCE_LIMITS, **lab_resource_limits.get(lab_name, {})).get('processes') or 0
+                     for lab_name in lab_names], default=0)
+    return 3 + max(1, jobs) * max(1, shards) * (4 + processes)
+
+
+def resource_limit_code(limits: dict) -> str:
+    """Code setting the resource limits of the process it runs in, empty if there are none to set"""
+    if resource is None:
+        return ''
+    settings = []
+    if limits.get('memory_mb') is not None:
+        settings.append(('RLIMIT_AS', limits['memory_mb'] * 1024 * 1024, limits['memory_mb'] * 1024 * 1024))
+    if limits.get('cpu_seconds') is not None:  # SIGXCPU at the soft limit, SIGKILL a second later
+        settings.append(('RLIMIT_CPU', limits['cpu_seconds'], limits['cpu_seconds'] + 1))
+    if limits.get('processes') is not None and user_process_limit is not None:
+        # RLIMIT_NPROC counts every process/thread of the user, user_process_limit leaves room for all of the run's
+        settings.append(('RLIMIT_NPROC', user_process_limit, user_process_limit))
+    if limits.get('file_size_mb') is not None:
+        settings.append(('RLIMIT_FSIZE', limits['file_size_mb'] * 1024 * 1024,
+                         limits['file_size_mb'] * 1024 * 1024))
+    if not settings:
+        return ''
+    return 'import resource\n' + ''.join(f'resource.setrlimit(resource.{name}, ({soft}, {hard}))\n'
+                                         for name, soft, hard in settings) + RESOURCE_LIMIT_HOOK_CODE
+
+
+# run after the resource limits are set: the error a limit raises (MemoryError, EFBIG writing a file, EAGAIN or
+# "can't start new thread" starting a process or thread) is recorded in GRADING_LIMIT_FILE when it is not
+# caught (sys.excepthook), fails a unittest test (GRADING_RESULT_CODE) or fails the import of the student's file
+# (identity_and_grading_code), all through check of the _resource_limits module. Output is never searched for
+# them, it may mention such an error without running into a limit.
+RESOURCE_LIMIT_HOOK_CODE = f"""import os, sys
+def limit_of(error):
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, MemoryError):
+            return 'memory_mb'
+        if isinstance(error, OSError) and error.errno == {errno.EFBIG}:
+            return 'file_size_mb'
+        if isinstance(error, BlockingIOError) and error.errno == {errno.EAGAIN} or \\
+                isinstance(error, RuntimeError) and str(error) == "can't start new thread":
+            return 'processes'
+        error = error.__cause__ or error.__context__
+    return None
+def check(error):
+    limit = limit_of(error)
+    if limit is not None and os.environ.get('GRADING_LIMIT_FILE'):
+        try:
+            with open(os.environ['GRADING_LIMIT_FILE'], 'w') as file:
+                file.write(limit)
+        except OSError:
+            pass
+def except_hook(exc_type, exc, exc_traceback, original=sys.excepthook):
+    check(exc)
+    original(exc_type, exc, exc_traceback)
+sys.excepthook = except_hook
+module = type(sys)('_resource_limits')
+module.check = check
+sys.modules['_resource_limits'] = module
+"""
+
+
+def exceeded_limit(returncode: int, limit_path: str, limits: dict):
+    """
+    Returns the RESOURCE_LIMITS key of the limit a finished student process ran into, None if there is none
+    (limit_path is its GRADING_LIMIT_FILE, see RESOURCE_LIMIT_HOOK_CODE)
+    """
+    if resource is None:
+        return None
+    try:
+        with open(limit_path) as file:
+            recorded = file.read()
+        os.remove(limit_path)
+    except OSError:
+        recorded = None
+    if limits.get('cpu_seconds') is not None and returncode == -signal.SIGXCPU:
+        return 'cpu_seconds'
+    # python ignores SIGXFSZ, writing past the limit raises an error that is recorded instead
+    if limits.get('file_size_mb') is not None and returncode == -signal.SIGXFSZ:
+        return 'file_size_mb'
+    if recorded in limits and limits[recorded] is not None:
+        return recorded
+    return None
+
+
+# run first in every grading run: records the outcome and time of every unittest test, the score is written with
+# them as json to GRADING_RESULT_FILE by the last line of the grading code (see grading_code). A shard of a
+# grading run (GRADING_SHARD is 'index/count') only loads every count-th test and leaves the score to the grader.
+GRADING_RESULT_CODE = """import json, os, sys, time, types, unittest
+start = time.perf_counter()
+tests = []
+test_starts = {}
+tests_run = 0
+def record_start(original):
+    def start_test(self, test):
+        global tests_run
+        tests_run += 1
+        test_starts[test.id()] = time.perf_counter()
+        return original(self, test)
+    return start_test
+def check_limit(error):
+    if '_resource_limits' in sys.modules:  # the error may come from a resource limit
+        sys.modules['_resource_limits'].check(error[1])
+def record(original, outcome):
+    def add(self, test, *args):
+        if outcome == 'error':
+            check_limit(args[0])
+        seconds = time.perf_counter() - test_starts.get(test.id(), time.perf_counter())
+        tests.append({'test': test.id(), 'outcome': outcome, 'seconds': round(seconds, 6)})
+        return original(self, test, *args)
+    return add
+def record_sub_test(original):
+    def add_sub_test(self, test, sub_test, error):
+        if error is None:
+            outcome = 'pass'
+        else:
+            outcome = 'fail' if issubclass(error[0], test.failureException) else 'error'
+            check_limit(error)
+        seconds = time.perf_counter() - test_starts.get(test.id(), time.perf_counter())
+        tests.append({'test': sub_test.id(), 'outcome': outcome, 'seconds': round(seconds, 6)})
+        return original(self, test, sub_test, error)
+    return add_sub_test
+result_class = unittest.TestResult
+result_class.startTest = record_start(result_class.startTest)
+for method, outcome in (('addSuccess', 'pass'), ('addFailure', 'fail'), ('addError', 'error'), ('addSkip', 'skip'),
+                        ('addExpectedFailure', 'expected_failure'), ('addUnexpectedSuccess', 'unexpected_success')):
+    setattr(result_class, method, record(getattr(result_class, method), outcome))
+result_class.addSubTest = record_sub_test(result_class.addSubTest)
+shard = os.environ.get('GRADING_SHARD')
+if shard:
+    shard_index, shard_count = map(int, shard.split('/'))
+    loaded_tests = 0
+    def shard_test_case_names(original):
+        def get_test_case_names(self, test_case_class):
+            global loaded_tests
+            names = []
+            for name in original(self, test_case_class):
+                if loaded_tests % shard_count == shard_index:
+                    names.append(name)
+                loaded_tests += 1
+            return names
+        return get_test_case_names
+    unittest.TestLoader.getTestCaseNames = shard_test_case_names(unittest.TestLoader.getTestCaseNames)
+def write(score):
+    result = {'score': None if shard else float(score()), 'tests': tests, 'tests_run': tests_run,
+              'seconds': round(time.perf_counter() - start, 6)}
+    result_path = os.environ['GRADING_RESULT_FILE']
+    with open(result_path + '.tmp', 'w') as file:
+        json.dump(result, file)
+    os.replace(result_path + '.tmp', result_path)
+module = types.ModuleType('_grading_result')
+module.write = write
+sys.modules['_grading_result'] = module
+"""
+
+
+# Main loop of a forkserver process, started as 'python -c' so it holds the modules of a fresh interpreter and
+# preload_modules only (nothing of this script, whose imports would hide student files with the same name):
+# imports the preload modules once, then forks a fresh child for every request received, replies with the
+# child's pid and then with its exit code, CPU time and maximum resident set size (from os.wait4) once it is
+# done. Code objects are kept by id, so the children of later requests for the same code inherit them already
+# loaded. Messages are marshalled and sent with their length first (see send_message and receive_message).
+FORKSERVER_CODE = """import _signal, marshal, os, sys
+def read_exactly(fd, size):
+    data = b''
+    while len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+def receive(fd):
+    return marshal.loads(read_exactly(fd, int.from_bytes(read_exactly(fd, 8), 'big')))
+def send(fd, message):
+    data = marshal.dumps(message)
+    data = len(data).to_bytes(8, 'big') + data
+    while data:
+        data = data[os.write(fd, data):]
+def run_forked_code(request):
+    _signal.signal(_signal.SIGINT, _signal.default_int_handler)
+    os.chdir(request['cwd'])
+    os.environ.update(request['env'])
+    for stream_fd, path in ((1, request['stdout']), (2, request['stderr'])):
+        file_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        os.dup2(file_fd, stream_fd)
+        os.close(file_fd)
+    # look like a fresh 'python -c' interpreter
+    sys.argv = ['-c']
+    sys.path[0] = ''
+    for finder in sys.meta_path:  # importlib.invalidate_caches without importing importlib
+        if hasattr(finder, 'invalidate_caches'):
+            finder.invalidate_caches()
+    main_module = type(sys)('__main__')
+    sys.modules['__main__'] = main_module
+    exit_code = 0
+    try:
+        exec(request['code'], main_module.__dict__)
+    except SystemExit as exit_request:
+        if exit_request.code is None:
+            exit_code = 0
+        elif isinstance(exit_request.code, int):
+            exit_code = exit_request.code
+        else:
+            print(exit_request.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        exc_type, exc, exc_traceback = sys.exc_info()
+        exc.__traceback__ = exc_traceback.tb_next  # hide this function from the traceback
+        sys.excepthook(exc_type, exc, exc.__traceback__)
+        exit_code = 1
+    finally:
+        for stream in (sys.stdout, sys.stderr, sys.__stdout__, sys.__stderr__):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        os._exit(exit_code)
+_signal.signal(_signal.SIGINT, _signal.SIG_IGN)  # the grading process decides when the forkserver stops
+request_fd, reply_fd = int(sys.argv[1]), int(sys.argv[2])
+for module in sys.argv[3:]:
+    try:
+        __import__(module)
+    except ImportError as err:
+        print(f'forkserver could not preload {module}: {err}', file=sys.stderr)
+code_objects = {}
+while True:
+    try:
+        request = receive(request_fd)
+    except EOFError:  # the grading process is done with this forkserver
+        break
+    if request['code'] is not None:
+        code_objects[request['code_id']] = marshal.loads(request['code'])
+    request['code'] = code_objects[request['code_id']]
+    pid = os.fork()
+    if pid == 0:
+        os.close(request_fd)
+        os.close(reply_fd)
+        run_forked_code(request)
+    try:
+        send(reply_fd, pid)
+        _, status, usage = os.wait4(pid, 0)
+        send(reply_fd, (os.waitstatus_to_exitcode(status), usage.ru_utime + usage.ru_stime, usage.ru_maxrss))
+    except BrokenPipeError:  # the grading process stopped while the child was running
+        break
+"""
+
+
+def send_message(fd: int, message):
+    """Sends a marshalled message to a forkserver (its length first, like send in FORKSERVER_CODE)"""
+    data = marshal.dumps(message)
+    data = len(data).to_bytes(8, 'big') + data
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def receive_message(fd: int):
+    """Receives a message sent by send in FORKSERVER_CODE, raises EOFError if the forkserver is gone"""
+    def read_exactly(size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = os.read(fd, size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+    return marshal.loads(read_exactly(int.from_bytes(read_exactly(8), 'big')))
+
+
+class ForkServer:
+    """
+    A python process with preload_modules already imported that forks a fresh child for every
+    student run, saving the interpreter start up and imports of a new 'python -c' process each time.
+    Only one child runs at a time, every grading thread has a forkserver of its own.
+    """
+
+    def __init__(self):
+        request_read, request_write = os.pipe()
+        reply_read, reply_write = os.pipe()
+        self.process = subprocess.Popen([sys.executable, '-c', FORKSERVER_CODE,
+                                         str(request_read), str(reply_write)] + preload_modules,
+                                        stdin=subprocess.DEVNULL, pass_fds=(request_read, reply_write))
+        os.close(request_read)
+        os.close(reply_write)
+        self.requests = request_write
+        self.replies = reply_read
+        self.output_dir = tempfile.mkdtemp(prefix='forkserver_', dir=scratch_location())
+        self.stdout_path = os.path.join(self.output_dir, 'stdout')
+        self.stderr_path = os.path.join(self.output_dir, 'stderr')
+        self.runs = 0
+        self.broken = False
+        self.closed = False
+        self.child = None
+        self.sent_code_ids = set()  # code objects the forkserver already has
+
+    def start(self, code: str, cwd: str, env: dict = None) -> 'ForkServerChild':
+        """
+        Forks a child running code inside cwd with env added to its environment variables,
+        its output goes to self.stdout_path and self.stderr_path. The code is compiled once and every
+        compiled code object is only sent to the forkserver the first time it is run.
+        """
+        code_id, marshalled_code = compile_student_code(code)
+        send_message(self.requests, {'code_id': code_id,
+                                     'code': marshalled_code if code_id not in self.sent_code_ids else None,
+                                     'cwd': cwd, 'env': env or {}, 'stdout': self.stdout_path,
+                                     'stderr': self.stderr_path})
+        self.sent_code_ids.add(code_id)
+        pid = receive_message(self.replies)
+        self.runs += 1
+        self.child = ForkServerChild(self, pid)
+        return self.child
+
+    def close(self):
+        """Stops the forkserver process (and a child still running) and removes its output files"""
+        if self.closed:  # closed by close_fork_servers, its pipes may already be other files
+            return
+        self.closed = self.broken = True
+        if self.child is not None:
+            self.child.kill()
+        os.close(self.requests)
+        os.close(self.replies)
+        try:
+            self.process.wait(timeout=TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+
+class ForkServerChild:
+    """Popen like handle of a child forked by a ForkServer"""
+
+    def __init__(self, server: ForkServer, pid: int):
+        self.server = server
+        self.pid = pid
+        self.returncode = None
+        self.cpu_time = 0.0
+        self.max_rss = 0
+
+    def wait(self, timeout: float = None) -> int:
+        """Waits for the child to exit and returns its exit code, raises subprocess.TimeoutExpired after timeout"""
+        if self.returncode is None:
+            if not select.select([self.server.replies], [], [], timeout)[0]:
+                raise subprocess.TimeoutExpired('forkserver child', timeout)
+            try:
+                self.returncode, self.cpu_time, self.max_rss = receive_message(self.server.replies)
+            except EOFError:  # the forkserver itself was killed
+                self.server.broken = True
+                self.returncode = -signal.SIGKILL
+        return self.returncode
+
+    def kill(self):
+        """Kills the child if it is still running"""
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+def compile_student_code(code: str) -> tuple:
+    """
+    Returns (id, marshalled code object) of code compiled the way 'python -c' would, every code is only
+    compiled once (prepare_grading_scripts compiles the grading code before any student runs)
+    """
+    with compiled_code_lock:
+        if code in compiled_code:
+            return compiled_code[code]
+    compiled = (hashlib.sha256(code.encode()).hexdigest(), marshal.dumps(compile(code, '<string>', 'exec',
+                                                                                 dont_inherit=True)))
+    with compiled_code_lock:
+        return compiled_code.setdefault(code, compiled)
+
+
+def get_fork_server():
+    """Returns the forkserver of the current thread, None if forkservers are turned off or not supported"""
+    if not USE_FORKSERVER or not hasattr(os, 'fork'):
+        return None
+    server = getattr(thread_state, 'fork_server', None)
+    if server is not None and (server.broken or server.runs >= FORKSERVER_MAX_RUNS):
+        close_fork_server(server)
+        server = None
+    if server is None:
+        server = ForkServer()
+        thread_state.fork_server = server
+        with fork_servers_lock:
+            fork_servers.append(server)
+    return server
+
+
+def close_fork_server(server: ForkServer):
+    """Stops a forkserver and forgets about it"""
+    with fork_servers_lock:
+        if server in fork_servers:
+            fork_servers.remove(server)
+    if getattr(thread_state, 'fork_server', None) is server:
+        thread_state.fork_server = None
+    server.close()
+
+
+def close_fork_servers():
+    """Stops the forkservers of every thread"""
+    with fork_servers_lock:
+        servers = fork_servers.copy()
+        fork_servers.clear()
+    for server in servers:
+        server.close()
+
+
+class CappedOutput:
+    """Collects the output of a student process written to it in chunks, keeping only its start and end"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0  # bytes written, kept or not
+
+    def write(self, data: bytes):
+        self.total += len(data)
+        room = self.max_bytes // 2 - len(self.head)
+        self.head += data[:max(room, 0)]
+        if len(data) > room:
+            self.tail += data[max(room, 0):]
+            del self.tail[:-(self.max_bytes - self.max_bytes // 2)]
+
+    def getvalue(self) -> bytes:
+        if self.total <= self.max_bytes:
+            return bytes(self.head + self.tail)
+        return bytes(self.head) + elision_marker(self.total - len(self.head) - len(self.tail)) + bytes(self.tail)
+
+
+def elision_marker(left_out: int) -> bytes:
+    """Line put in place of output that was too long to keep"""
+    return f'\n... {left_out} bytes of output left out ...\n'.encode()
+
+
+def decode_output(data: bytes) -> str:
+    """Decodes captured output the same way subprocess text mode would"""
+    return io.TextIOWrapper(io.BytesIO(data), errors='replace').read()
+
+
+def read_output(path: str, max_bytes: int) -> str:
+    """Reads a captured output file, only its start and end if it is longer than max_bytes"""
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size <= max_bytes:
+            return decode_output(file.read())
+        head = file.read(max_bytes // 2)
+        file.seek(size - (max_bytes - max_bytes // 2))
+        tail = file.read()
+    return decode_output(head + elision_marker(size - len(head) - len(tail)) + tail)
+
+
+def file_size(path: str) -> int:
+    """Returns the size of a file, 0 if it does not exist (yet)"""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def read_pipe(pipe, output: CappedOutput, max_bytes, process: subprocess.Popen):
+    """Reads a pipe of process into output until it is closed, kills the process once it wrote more than max_bytes"""
+    with pipe:
+        while True:
+            data = pipe.read1(65536)
+            if not data:
+                break
+            output.write(data)
+            if max_bytes is not None and output.total > max_bytes >= output.total - len(data):
+                process.kill()  # Popen.kill does nothing if the process is already done
+
+
+def wait_in_phases(wait, timeout: float, phase_file: str = None, phase_timeout: float = None):
+    """
+    Calls wait(seconds) until it stops raising subprocess.TimeoutExpired and returns its result.
+    Raises subprocess.TimeoutExpired once timeout seconds pass, the time limit starts over with
+    phase_timeout seconds (timeout if None) once phase_file is created, so each phase of a single
+    launch run gets a time limit of its own. Raises GradingStopped once the run is stopping.
+    """
+    deadline = time.monotonic() + timeout
+    phase_done = phase_file is None
+    while True:
+        remaining = max(deadline - time.monotonic(), 0)
+        try:
+            return wait(min(remaining, STOP_POLL_INTERVAL if phase_done else PHASE_POLL_INTERVAL))
+        except subprocess.TimeoutExpired:
+            if grading_stopped.is_set():
+                raise GradingStopped()
+            if not phase_done and os.path.exists(phase_file):
+                phase_done = True
+                deadline = time.monotonic() + (phase_timeout if phase_timeout is not None else timeout)
+            elif time.monotonic() >= deadline:
+                raise
+
+
+def run_student_code(code: str, workspace: str, timeout: float, env: dict = None, phase_file: str = None,
+                     phase_timeout: float = None, limits: dict = None) -> subprocess.CompletedProcess:
+    """
+    Runs python code inside a student's workspace like 'python -c code' would and returns the completed process
+    with its output as text. env is added to the environment variables of the code and limits (see RESOURCE_LIMITS)
+    are set on its process. Uses the forkserver of the current thread when available. A process killed by a signal
+    sets thread_state.killed_by_signal, its result is not cached (see check_submission).
+    Raises subprocess.TimeoutExpired if the code runs for more than timeout seconds
+    (per phase, see wait_in_phases), InputInCode if it tries to read input, ResourceLimitExceeded if it
+    runs into one of its limits and GradingStopped if the run is stopping (before or while it runs). Only the start and end of output longer than MAX_OUTPUT_KB are kept.
+    """
+    limits = limits or {}
+    max_output = MAX_OUTPUT_KB * 1024
+    max_printed = limits['output_mb'] * 1024 * 1024 if limits.get('output_mb') is not None else None
+    code = wrap_student_code(code, limits)
+    limit_path = f'{workspace}_limit_{threading.get_ident()}'  # outside the workspace, one per thread (shards)
+    env = dict(env or {}, GRADING_LIMIT_FILE=limit_path)
+    with contextlib.suppress(FileNotFoundError):  # left by a run that timed out or read input
+        os.remove(limit_path)
+    with job_token():
+        if grading_stopped.is_set():
+            raise GradingStopped()
+        completed, printed = run_student_process(code, workspace, timeout, env, phase_file, phase_timeout,
+                                                 max_output, max_printed)
+    if completed.returncode < 0:  # by a limit, ctrl+C, the grader stopping, a dead forkserver...
+        thread_state.killed_by_signal = True
+
+    if completed.returncode == INPUT_EXIT_CODE:
+        raise InputInCode()
+    if max_printed is not None and printed > max_printed:
+        raise ResourceLimitExceeded('output_mb')
+    limit = exceeded_limit(completed.returncode, limit_path, limits)
+    if limit is not None:
+        raise ResourceLimitExceeded(limit)
+    return completed
+
+
+def run_student_process(code: str, workspace: str, timeout: float, env: dict, phase_file: str,
+                        phase_timeout: float, max_output: int, max_printed) -> tuple:
+    """
+    Runs the (wrapped) code of run_student_code in a forked child or a new process, returns the completed process
+    and the most bytes it printed to stdout or stderr
+    """
+    server = get_fork_server()
+    if server is not None:
+        try:
+            child = server.start(code, workspace, env)
+        except (EOFError, OSError):  # the forkserver died, use a regular process for this run
+            close_fork_server(server)
+            server = None
+    if server is None:
+        process = subprocess.Popen([sys.executable, '-c', code], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, cwd=workspace, env=dict(os.environ, **(env or {})))
+        # the output is read as it is printed, so a student printing in a loop never fills the grader's memory
+        outputs = [CappedOutput(max_output), CappedOutput(max_output)]
+        readers = [threading.Thread(target=read_pipe, args=(pipe, output, max_printed, process), daemon=True)
+                   for pipe, output in zip((process.stdout, process.stderr), outputs)]
+        for reader in readers:
+            reader.start()
+        try:
+            wait_in_phases(process.wait, timeout, phase_file, phase_timeout)
+        except (subprocess.TimeoutExpired, GradingStopped):
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            for reader in readers:
+                reader.join()
+        printed = max(output.total for output in outputs)
+        completed = subprocess.CompletedProcess(process.args, process.returncode, decode_output(outputs[0].getvalue()),
+                                                decode_output(outputs[1].getvalue()))
+    else:
+        def wait_for_child(seconds: float) -> int:
+            """child.wait that stops the child once it printed more than max_printed"""
+            deadline = time.monotonic() + seconds
+            while True:
+                try:
+                    return child.wait(min(max(deadline - time.monotonic(), 0), OUTPUT_POLL_INTERVAL))
+                except subprocess.TimeoutExpired:
+                    if max_printed is not None and max(file_size(server.stdout_path),
+                                                       file_size(server.stderr_path)) > max_printed:
+                        child.kill()
+                        return child.wait()
+                    if time.monotonic() >= deadline:
+                        raise
+
+        try:
+            wait_in_phases(wait_for_child, timeout, phase_file, phase_timeout)
+        except (subprocess.TimeoutExpired, GradingStopped):
+            child.kill()
+            child.wait()
+            raise
+        finally:
+            run_report.add_child_usage(child.cpu_time, child.max_rss)
+        printed = max(file_size(server.stdout_path), file_size(server.stderr_path))
+        completed = subprocess.CompletedProcess(['forkserver child'], child.returncode,
+                                                read_output(server.stdout_path, max_output),
+                                                read_output(server.stderr_path, max_output))
+    return completed, printed
+
+
+@contextlib.contextmanager
+def job_token():
+    """
+    Holds one of the job tokens shared by every lab of a --config run while a student process runs, so all the
+    labs together never run more than --jobs student processes at once (does nothing outside a --config run)
+    """
+    if job_server is None:
+        yield
+        return
+    token = os.read(job_server[0], 1)
+    try:
+        yield
+    finally:
+        os.write(job_server[1], token)
+
+
+def wrap_student_code(code: str, limits: dict) -> str:
+    """Returns code with the stdin guard and the resource limits of a student process set up before it"""
+    return student_code_prefix(tuple(sorted(limits.items()))) + code
+
+
+@functools.lru_cache(maxsize=None)
+def student_code_prefix(limit_items: tuple) -> str:
+    """First line of every student process (see wrap_student_code), limit_items are the items of its limits"""
+    limit_code = resource_limit_code(dict(limit_items))
+    # the guard and limits are set on the first line so line numbers in tracebacks stay the same
+    return f'exec({STDIN_GUARD_CODE!r}, {{}}); exec({SIGINT_CODE!r}, {{}}); ' + \
+        (f'exec({limit_code!r}, {{}}); ' if limit_code else '')
+
+
+def get_id_and_author(lab_name: str, workspace: str, check_team=False, timeout: float = TIMEOUT) -> tuple:
+    """Returns the current name and id of the lab, 'syntaxError' if the file can't run,
+    'TimeoutExpired' if the file takes longer than timeout to load, 'InputInCode' if it reads input and
+    'ResourceLimitExceeded' with the limit's RESOURCE_LIMITS key if it runs into a resource limit
+    """
+    try:
+        name_and_id_check = run_student_code(name_and_id_check_code(lab_name, check_team), workspace, timeout,
+                                             limits=resource_limits_of(lab_name))
+    except subprocess.TimeoutExpired:  # Possible infinite loop
+        return 'TimeoutExpired', 'TimeoutExpired'
+    except InputInCode:
+        return 'InputInCode', 'InputInCode'
+    except ResourceLimitExceeded as limit_error:
+        return 'ResourceLimitExceeded', limit_error.limit
+
+    return parse_identity(name_and_id_check.stdout, name_and_id_check.stderr)
+
+
+@functools.lru_cache(maxsize=None)
+def name_and_id_check_code(lab_name: str, check_team: bool) -> str:
+    """Code printing the student number and author of the student's file (see get_id_and_author)"""
     name_exist_check_code = f"import {lab_name}\n" + \
                             f"if hasattr({lab_name}, '__student_number__'):\n" \
                             f"\tprint({lab_name}.__student_number__)\n" \
@@ -182,140 +1407,537 @@ def get_id_and_author(lab_name: str,check_team=False) -> tuple:
                             "\tprint()"
     if check_team:
         name_exist_check_code += f"\nfrom {lab_name} import __team__"
-    try:
-        name_and_id_check = subprocess.run([sys.executable, '-c', name_exist_check_code], capture_output=True,
-                                           text=True, timeout=TIMEOUT)
-        if name_and_id_check.stderr != '':
-            return 'syntaxError', 'syntaxError'
-        name_and_id_exist = name_and_id_check.stdout.split('\n')
-        given_name = name_and_id_exist[-2]
-        given_number = name_and_id_exist[-3].replace(' ', '')
-    except subprocess.TimeoutExpired:  # Possible infinite loop
-        return 'TimeoutExpired', 'TimeoutExpired'
+    return name_exist_check_code
+
 
+def parse_identity(stdout: str, stderr: str) -> tuple:
+    """Returns the student number and author printed last by a name/ID check, 'syntaxError' if it wrote errors"""
+    if stderr != '':
+        return 'syntaxError', 'syntaxError'
+    name_and_id_exist = stdout.split('\n')
+    given_name = name_and_id_exist[-2]
+    given_number = name_and_id_exist[-3].replace(' ', '')
     return given_number, given_name
 
 
-def grade(lab_grading_software_name: str) -> tuple:
+def prescreen_submission(py_sources: dict, lab_name: str):
+    """
+    Reads a student's file without running it. Returns ('syntaxError', 'syntaxError') if it does not compile,
+    the (student number, author) get_id_and_author would return if importing the file can only run plain
+    definitions, literal assignments and standard library imports, and None if the file has to be run to know
+    """
+    with prescreen_lock, warnings.catch_warnings(record=True) as compile_warnings:
+        warnings.simplefilter('always')
+        try:
+            tree = compile(py_sources[lab_name + '.py'], lab_name + '.py', 'exec', ast.PyCF_ONLY_AST, True)
+            compile(tree, lab_name + '.py', 'exec', 0, True)  # some errors are only found when compiling the tree
+        except (SyntaxError, ValueError):  # ValueError: null bytes in the file
+            return 'syntaxError', 'syntaxError'
+        except Exception:  # e.g. nested too deeply, leave it to the real import
+            return None
+    if compile_warnings:  # importing would print the warnings, which counts as an error
+        return None
+
+    values = {}
+    if not import_runs_only_definitions(tree.body, py_sources, set(), values):
+        return None
+    if TEAM_NAME_CHECK and '__team__' not in values:
+        return 'syntaxError', 'syntaxError'  # 'from lab import __team__' would fail
+    identity = [str(values.get(name, '')) for name in ('__student_number__', '__author__')]
+    if any('\n' in value or '\r' in value for value in identity):  # printed over more than one line
+        return None
+    return identity[0].replace(' ', ''), identity[1]
+
+
+def import_runs_only_definitions(statements: list, py_sources: dict, defined: set, values: dict) -> bool:
     """
-    Runs the grading script on the student's code, returns a tuple of score, feedback
+    Returns True if running statements (the body of a module or class) can't fail, loop, print or read input:
+    docstrings, literal assignments (saved in values), plain function and class definitions, imports of
+    standard library modules and an if __name__ == '__main__' block. defined collects the names defined.
     """
+    for statement in statements:
+        if isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Constant):
+            continue
+        elif isinstance(statement, ast.Pass):
+            continue
+        elif isinstance(statement, ast.Assign):
+            if not all(isinstance(target, ast.Name) for target in statement.targets):
+                return False
+            try:
+                value = ast.literal_eval(statement.value)
+            except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+                return False
+            for target in statement.targets:
+                values[target.id] = value
+                defined.add(target.id)
+        elif isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            arguments = statement.args
+            annotations = [argument.annotation for argument in
+                           arguments.posonlyargs + arguments.args + arguments.kwonlyargs +
+                           [arguments.vararg, arguments.kwarg] if argument is not None] + [statement.returns]
+            defaults = arguments.defaults + [default for default in arguments.kw_defaults if default is not None]
+            if statement.decorator_list or \
+                    not all(annotation is None or is_safe_annotation(annotation, defined)
+                            for annotation in annotations) or \
+                    not all(is_literal(default) for default in defaults):
+                return False
+            defined.add(statement.name)
+        elif isinstance(statement, ast.ClassDef):
+            if statement.decorator_list or statement.bases or statement.keywords or \
+                    not import_runs_only_definitions(statement.body, py_sources, set(defined), {}):
+                return False
+            defined.add(statement.name)
+        elif isinstance(statement, ast.Import):
+            for alias in statement.names:
+                # the standard library modules are only listed from Python 3.10, before that no import is trusted
+                if '.' in alias.name or alias.name not in getattr(sys, 'stdlib_module_names', ()) or \
+                        alias.name + '.py' in py_sources or alias.name + '.py' in original_grading_material_files or \
+                        importlib.util.find_spec(alias.name) is None:
+                    return False
+                defined.add(alias.asname or alias.name)
+        elif isinstance(statement, ast.If) and is_main_check(statement.test):
+            if not import_runs_only_definitions(statement.orelse, py_sources, defined, values):
+                return False
+        else:
+            return False
+    return True
+
+
+def is_literal(node: ast.AST) -> bool:
+    """Returns True if node is a literal (a constant or a container of constants)"""
     try:
+        ast.literal_eval(node)
+        return True
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return False
 
-        # Slightly modify the grading file
-        code = 'import sys\n' \
-               'sys.stderr = sys.stdout\n' \
-               + open(lab_grading_software_name).read() + '\n' \
-               + f'print(\'$#%|\'+str({SCORE_CODE})+\'|%#$\', end=\'\')'
 
-        # will throw timeout error if exceeds TIMEOUT seconds
-        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
-                                timeout=TIMEOUT)
+def is_safe_annotation(node: ast.AST, defined: set) -> bool:
+    """
+    Returns True if evaluating an annotation can't fail: constants and builtin or already defined names,
+    subscripted (list[int]) or joined with | (int | None)
+    """
+    if isinstance(node, ast.Constant):
+        return True
+    if isinstance(node, ast.Name):
+        return node.id in defined or (hasattr(builtins, node.id) and node.id not in ('__import__', 'input'))
+    if isinstance(node, ast.Subscript):
+        return isinstance(node.value, ast.Name) and node.value.id in ('list', 'dict', 'tuple', 'set', 'frozenset',
+                                                                      'type') and \
+            is_safe_annotation(node.slice, defined)
+    if isinstance(node, ast.Tuple):
+        return all(is_safe_annotation(element, defined) for element in node.elts)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitOr) and sys.version_info >= (3, 10):
+        return all(isinstance(side, ast.Constant) and side.value is None or
+                   isinstance(side, ast.Name) and side.id in ('int', 'float', 'str', 'bool', 'list', 'dict',
+                                                              'tuple', 'set', 'bytes', 'complex')
+                   for side in (node.left, node.right))
+    return False
+
+
+def is_main_check(test: ast.AST) -> bool:
+    """Returns True if test is __name__ == '__main__' (its block does not run when the file is imported)"""
+    if not isinstance(test, ast.Compare) or len(test.ops) != 1 or not isinstance(test.ops[0], ast.Eq):
+        return False
+    sides = [test.left, test.comparators[0]]
+    return any(isinstance(side, ast.Name) and side.id == '__name__' for side in sides) and \
+        any(isinstance(side, ast.Constant) and side.value == '__main__' for side in sides)
 
-        # Split code output
-        output = result.stdout.split('\n')
 
-        # get score
-        try:
-            gscore = parse_pattern(output[-1])  # ensures it is only reading what was intended to be the score
-            # Add the rest to the feedback
-            feedback_for_file = '\n'.join(output[:-1])
-        except ValueError:
-            gscore = -1
-            feedback_for_file = test_code_error_prints()
+def get_id_author_and_grading_run(lab_name: str, workspace: str, student_id: str, check_team=False) -> tuple:
+    """
+    Single launch version of get_id_and_author followed by the grading run, the student's file is only
+    imported once. Returns the given ID and author (with the same 'syntaxError', 'TimeoutExpired', 'InputInCode'
+    and 'ResourceLimitExceeded' values) and the grading run: the completed process, the subprocess.TimeoutExpired
+    error if grading took too long, the InputInCode or ResourceLimitExceeded error if grading made it read input
+    or run into a resource limit, or None if the name/ID check failed (the student is not graded then).
+    """
+    identity_path = workspace + '_identity.json'
+    result_path = workspace + '_result.json'
+    code = identity_and_grading_code(lab_name, LAB_NAME_GRADING_SOFTWARE_INDEX[lab_name] + '.py', check_team)
+    env = {'GRADING_IDENTITY_FILE': identity_path, 'GRADING_EXPECTED_ID': student_id,
+           'GRADING_RESULT_FILE': result_path}
+    identity_timeout, grading_timeout = timeouts_of(lab_name)
+    limits = resource_limits_of(lab_name)
+    try:
+        grading_run = run_student_code(code, workspace, identity_timeout, env=env, phase_file=identity_path,
+                                       phase_timeout=grading_timeout, limits=limits)
+    except (subprocess.TimeoutExpired, InputInCode, ResourceLimitExceeded) as error:
+        grading_run = error
+    else:
+        grading_run.result = read_grading_result(result_path)
 
-    except subprocess.TimeoutExpired:  # Possible infinite loop
-        gscore = -1  # to highlight student on csv when opened in Excel
-        feedback_for_file = infinite_loop_prints()
+    try:
+        with open(identity_path) as file:
+            identity = json.load(file)
+        os.remove(identity_path)
+    except FileNotFoundError:  # never got past importing the student's file
+        if isinstance(grading_run, subprocess.TimeoutExpired):  # Possible infinite loop
+            return 'TimeoutExpired', 'TimeoutExpired', None
+        if isinstance(grading_run, InputInCode):
+            return 'InputInCode', 'InputInCode', None
+        if isinstance(grading_run, ResourceLimitExceeded):
+            return 'ResourceLimitExceeded', grading_run.limit, None
+        return 'syntaxError', 'syntaxError', None
+
+    given_id, given_author = parse_identity(identity['stdout'], identity['stderr'])
+    if not identity_passes(given_id, given_author, student_id):  # the child stopped before grading
+        if isinstance(grading_run, ResourceLimitExceeded):  # importing the student's file ran into it
+            return 'ResourceLimitExceeded', grading_run.limit, None
+        grading_run = None
+    return given_id, given_author, grading_run
+
+
+@functools.lru_cache(maxsize=None)
+def identity_and_grading_code(lab_name: str, lab_grading_software_name: str, check_team: bool) -> str:
+    """
+    Code for a single launch run: imports the student's file with its output held back, writes what
+    get_id_and_author would have read as json to GRADING_IDENTITY_FILE, and if the ID matches
+    GRADING_EXPECTED_ID runs the grading script (the held back output is printed first so the feedback
+    is the same as grading in a separate run).
+    """
+    output_mb = resource_limits_of(lab_name).get('output_mb')
+    max_printed = output_mb * 1024 * 1024 if output_mb is not None else None
+    identity_check_code = f"""import io, json, os, sys, traceback
+class HeldBack(io.StringIO):
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+    def write(self, text):
+        written = super().write(text)
+        if {max_printed} is not None and self.tell() > {max_printed}:  # printing in a loop, the grader stops it
+            self.stream.write(self.getvalue())
+            self.stream.flush()
+            os._exit(1)
+        return written
+stdout, stderr = sys.stdout, sys.stderr
+sys.stdout, sys.stderr = HeldBack(stdout), HeldBack(stderr)
+try:
+    import {lab_name}
+    lines = [str(getattr({lab_name}, '__student_number__', '')), str(getattr({lab_name}, '__author__', ''))]
+    if {check_team} and not hasattr({lab_name}, '__team__'):
+        print("ImportError: cannot import name '__team__' from '{lab_name}'", file=sys.stderr)
+except BaseException as error:
+    traceback.print_exc()
+    lines = ['', '']
+    if '_resource_limits' in sys.modules:  # the import may have run into a resource limit
+        sys.modules['_resource_limits'].check(error)
+printed, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+sys.stdout, sys.stderr = stdout, stderr
+
+identity = '\\n'.join(lines) + '\\n'
+identity_path = os.environ['GRADING_IDENTITY_FILE']
+with open(identity_path + '.tmp', 'w') as file:
+    json.dump({{'stdout': identity, 'stderr': errors[-1000:]}}, file)
+os.replace(identity_path + '.tmp', identity_path)
+
+given = identity.split('\\n')
+if errors or not given[-2] or given[-3].replace(' ', '') != os.environ['GRADING_EXPECTED_ID']:
+    sys.exit(0)  # the score would not count, no need to grade
+sys.stdout.write(printed)
+"""
+    # run in a namespace of its own and on the first line so the grading script's line numbers stay the same
+    return f'exec({identity_check_code!r}, {{}}); ' + grading_code(lab_grading_software_name)
 
-    return gscore, feedback_for_file  # named gscore to not interfere with score
+
+@functools.lru_cache(maxsize=None)
+def grading_code(lab_grading_software_name: str) -> str:
+    """
+    Slightly modifies the grading file so errors become feedback, and the score and the outcome of every test
+    are written to GRADING_RESULT_FILE (see GRADING_RESULT_CODE) instead of being mixed in with the output
+    """
+    # the recorder is set up on the first line so the grading script's line numbers stay the same
+    return f'exec({GRADING_RESULT_CODE!r}, {{}}); import sys\n' \
+           'sys.stderr = sys.stdout\n' \
+           + grading_script(lab_grading_software_name) + '\n' \
+           + f'__import__(\'_grading_result\').write(lambda: {SCORE_CODE})'
 
 
-def parse_pattern(s: str) -> float:
+def grading_script(lab_grading_software_name: str) -> str:
+    """Returns the source of a grading script, it is only read from the grading material folder once"""
+    if lab_grading_software_name not in grading_scripts:
+        with open(os.path.join(GRADING_MATERIAL_LOCATION, lab_grading_software_name)) as file:
+            grading_scripts[lab_grading_software_name] = file.read()
+    return grading_scripts[lab_grading_software_name]
+
+
+def prepare_grading_scripts():
+    """
+    Reads and compiles the grading script of every lab and the code run in its student processes (name/ID check,
+    grading and single launch) once, exits before any student is run if SCORE_CODE or a grading script has
+    an error. With PRELOAD_GRADING_IMPORTS the installed modules the grading scripts import are added to
+    preload_modules, so they are loaded once by the forkserver instead of once per student.
+    """
+    try:
+        compile(SCORE_CODE, 'SCORE_CODE', 'eval')
+    except SyntaxError as err:
+        sys.exit(f"SCORE_CODE has an error: {err}")
+    for lab_name, lab_grading_software_name in LAB_NAME_GRADING_SOFTWARE_INDEX.items():
+        script_path = os.path.join(GRADING_MATERIAL_LOCATION, lab_grading_software_name + '.py')
+        try:
+            compile(grading_script(lab_grading_software_name + '.py'), script_path, 'exec', dont_inherit=True)
+        except (OSError, SyntaxError, ValueError) as err:
+            sys.exit(f"grading script of {lab_name} can't be used: {err}")
+        if PRELOAD_GRADING_IMPORTS:
+            for module_name in sorted(code_imports(grading_script(lab_grading_software_name + '.py'))):
+                if module_name not in preload_modules and preloadable(module_name):
+                    preload_modules.append(module_name)
+        limits = resource_limits_of(lab_name)
+        for code in (name_and_id_check_code(lab_name, TEAM_NAME_CHECK),
+                     grading_code(lab_grading_software_name + '.py'),
+                     identity_and_grading_code(lab_name, lab_grading_software_name + '.py', TEAM_NAME_CHECK)):
+            compile_student_code(wrap_student_code(code, limits))
+
+
+def code_imports(source: str) -> set:
+    """Returns the names of the modules imported (not relative imports) anywhere in source"""
+    modules = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+            modules.add(node.module)
+    return modules
+
+
+def preloadable(module_name: str) -> bool:
+    """
+    Returns True if a forkserver can import module_name before it knows which student it runs: an installed
+    module, not a lab, a module in the grading material folder or one next to this script
     """
-    Extracts a float value from the input string if it starts with "$#%|" and ends with "|%#$".
+    top_level_name = module_name.partition('.')[0]
+    if top_level_name in LAB_NAME_GRADING_SOFTWARE_INDEX or \
+            os.path.exists(os.path.join(GRADING_MATERIAL_LOCATION, top_level_name + '.py')) or \
+            os.path.isdir(os.path.join(GRADING_MATERIAL_LOCATION, top_level_name)):
+        return False
+    try:
+        spec = importlib.util.find_spec(top_level_name)  # only finds the module, nothing is run
+    except (ImportError, ValueError):
+        return False
+    if spec is None or spec.origin is None:  # not installed, or a namespace package (a plain folder)
+        return False
+    script_folder = os.path.dirname(os.path.abspath(__file__))
+    return not os.path.isabs(spec.origin) or \
+        os.path.commonpath([script_folder, os.path.abspath(spec.origin)]) != script_folder
 
-    Args:
-        s: The input string to parse.
 
-    Returns:
-        The float value contained within the input string.
+def read_grading_result(result_path: str, shard: bool = False):
+    """
+    Returns the result a grading run wrote to result_path ({'score', 'tests', 'tests_run', 'seconds'}, see
+    GRADING_RESULT_CODE) and removes the file, None if the run did not write one (the grading script or score
+    code failed). The score of a shard is None, it is scored by merge_shard_results.
+    """
+    try:
+        with open(result_path) as file:
+            result = json.load(file)
+    except (OSError, ValueError):
+        return None
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(result_path)
+    if not isinstance(result, dict) or not isinstance(result.get('tests'), list):
+        return None
+    if not shard and not isinstance(result.get('score'), (int, float)):
+        return None
+    return result
+
+
+def grade(lab_grading_software_name: str, workspace: str, timeout: float = TIMEOUT, limits: dict = None,
+          shards: int = 1):
+    """
+    Runs the grading script on the student's code inside the student's workspace, returns the completed process
+    (with the result it wrote in its result attribute, see read_grading_result), the subprocess.TimeoutExpired
+    error if it took too long or the InputInCode or ResourceLimitExceeded error if it read input or ran into
+    one of its limits. The tests are split across shards processes if it is more than 1 (see grade_in_shards).
+    """
+    if shards > 1:
+        return grade_in_shards(lab_grading_software_name, workspace, timeout, limits, shards)
+    result_path = workspace + '_result.json'
+    try:
+        # will throw timeout error if exceeds timeout seconds
+        grading_run = run_student_code(grading_code(lab_grading_software_name), workspace, timeout,
+                                       env={'GRADING_RESULT_FILE': result_path}, limits=limits)
+        grading_run.result = read_grading_result(result_path)
+        return grading_run
+    except subprocess.TimeoutExpired as timeout_error:  # Possible infinite loop
+        return timeout_error
+    except (InputInCode, ResourceLimitExceeded) as error:
+        return error
+
+
+def grade_in_shards(lab_grading_software_name: str, workspace: str, timeout: float, limits: dict, shards: int):
+    """
+    Runs the grading script in shards processes at once, each running every shards-th test of the script (see
+    GRADING_RESULT_CODE), and returns them merged into one grading run like grade would: the output of every
+    shard one after another, with the result of all the tests. The first error of a shard is returned instead.
+    """
+    def run_shard(index: int):
+        result_path = f'{workspace}_result_{index}.json'
+        try:
+            shard_run = run_student_code(grading_code(lab_grading_software_name), workspace, timeout,
+                                         env={'GRADING_RESULT_FILE': result_path,
+                                              'GRADING_SHARD': f'{index}/{shards}'}, limits=limits)
+        except (subprocess.TimeoutExpired, InputInCode, ResourceLimitExceeded) as error:
+            return error
+        shard_run.result = read_grading_result(result_path, shard=True)
+        return shard_run
+
+    # every shard pool thread has a forkserver of its own, so the shards really run at the same time
+    if shard_pool is not None:
+        futures = [shard_pool.submit(run_shard, index) for index in range(1, shards)]
+        try:
+            first_run = run_shard(0)
+        finally:  # the other shards run in the workspace until they are done, even if the run is stopping
+            wait_for_futures(futures)
+        shard_runs = [first_run] + [future.result() for future in futures]
+    else:
+        shard_runs = [run_shard(index) for index in range(shards)]
+    if any(isinstance(shard_run, subprocess.CompletedProcess) and shard_run.returncode < 0
+           for shard_run in shard_runs):  # on a thread of the shard pool, see run_student_code
+        thread_state.killed_by_signal = True
+    for shard_run in shard_runs:
+        if isinstance(shard_run, Exception):
+            return shard_run
+
+    grading_run = subprocess.CompletedProcess(['grading shards'], 0, ''.join(run.stdout for run in shard_runs), '')
+    results = [shard_run.result for shard_run in shard_runs]
+    grading_run.result = None if None in results else merge_shard_results(results)
+    return grading_run
 
-    Raises:
-        ValueError: If the input string does not match the expected format or if the float value cannot be extracted.
+
+def merge_shard_results(results: list):
+    """
+    Returns the results of the shards of a grading run as the result of one run, scored by SCORE_CODE with a
+    result and passes made from the outcomes of all the tests, None if SCORE_CODE fails
     """
-    if not s.startswith("$#%|") or not s.endswith("|%#$"):
-        raise ValueError("Input string does not match the expected format")
+    tests = [test for result in results for test in result['tests']]
+
+    def with_outcome(outcome: str) -> list:
+        return [(test['test'], '') for test in tests if test['outcome'] == outcome]
+
+    merged = types.SimpleNamespace(testsRun=sum(result['tests_run'] for result in results),
+                                   failures=with_outcome('fail'), errors=with_outcome('error'),
+                                   skipped=with_outcome('skip'), expectedFailures=with_outcome('expected_failure'),
+                                   unexpectedSuccesses=with_outcome('unexpected_success'), shouldStop=False)
+    merged.wasSuccessful = lambda: not (merged.failures or merged.errors or merged.unexpectedSuccesses)
+    passes = merged.testsRun - len(merged.failures) - len(merged.errors)
     try:
-        start = s.index('|') + 1
-        end = s.index('|', start)
-        return float(s[start:end])
-    except ValueError:
-        raise ValueError("Failed to parse float value from input string")
+        score = float(eval(SCORE_CODE, {'result': merged, 'passes': passes}))
+    except Exception:
+        return None
+    return {'score': score, 'tests': tests, 'tests_run': merged.testsRun,
+            'seconds': max(result['seconds'] for result in results)}
+
+
+def test_shards_of(lab_name: str) -> int:
+    """Returns the number of processes the tests of a lab are split across (LAB_TEST_SHARDS)"""
+    return LAB_TEST_SHARDS.get(lab_name, 1)
+
+
+def score_grading_run(grading_run, student: dict) -> tuple:
+    """
+    Returns a tuple of score, feedback from a completed grading run (one that timed out is an infinite loop)
+    """
+    if grading_run.result is not None:
+        gscore = grading_run.result['score']
+        # the whole output is feedback, the score is not part of it
+        feedback_for_file = grading_run.stdout.removesuffix('\n')
+
+    else:  # the grading script or score code failed
+        gscore = -1
+        feedback_for_file = test_code_error_prints(student)
+
+    return gscore, feedback_for_file  # named gscore to not interfere with score
+
+
+def review_print(student: dict, *lines: str):
+    """Saves a message for the marker, it is printed to the console once the student is done being graded
+    so messages from students graded in parallel do not mix
+    """
+    student['console'].append('\n'.join(lines))
 
 
-def mismatching_name_prints():
+def mismatching_name_prints(student: dict, given_id: str, given_author: str):
     """Prints necessary mismatching name actions
     """
+    name, student_id, folder = student['name'], student['student_id'], student['folder']
+
     # add to file
     feedback_for_file = 'File ID#:' + given_id + '-> Expected ID#:' + student_id + '\n'
     feedback_for_file += 'File Author name:' + given_author + '-> Expected Author name:' + name + '\n'
     feedback_for_file += 'FURTHER REVIEW REQUIRED' + '\n'
 
     # Tell TA on console
-    print(
-        'Review student (issue with name or ID): ' + name + ', ID#: ' + student_id + ', Folder name:\'' + folder + '\'',
-        file=original_stderr)
-    print('File ID#:', given_id, '-> Expected ID#:', student_id, file=original_stderr)
-    print('File Author name:', given_author, '-> Expected Author name:', name, file=original_stderr)
-    print(file=original_stderr)
+    review_print(student,
+                 'Review student (issue with name or ID): ' + name + ', ID#: ' + student_id + ', Folder name:\'' + folder + '\'',
+                 'File ID#: ' + given_id + ' -> Expected ID#: ' + student_id,
+                 'File Author name: ' + given_author + ' -> Expected Author name: ' + name,
+                 '')
     return feedback_for_file
 
 
-def infinite_loop_prints():
+def infinite_loop_prints(student: dict):
     """Prints necessary infinite loop actions
     """
     feedback_for_file = 'Possible infinite loop or input in code' + '\n'
     feedback_for_file += 'FURTHER REVIEW REQUIRED' + '\n'
-    print(
-        'Review student (possible infinite loop or input): ' + name + ', ID#: ' + student_id + ', Folder name:\'' + folder + '\'',
-        file=original_stderr)
-    print(file=original_stderr)
+    review_print(student,
+                 'Review student (possible infinite loop or input): ' + student['name'] + ', ID#: ' + student['student_id'] + ', Folder name:\'' + student['folder'] + '\'',
+                 '')
+    return feedback_for_file
+
+
+def input_in_code_prints(student: dict):
+    """Prints necessary input in code actions
+    """
+    feedback_for_file = 'Code waits for input(), input is not allowed in the submitted file' + '\n'
+    feedback_for_file += 'FURTHER REVIEW REQUIRED' + '\n'
+    review_print(student,
+                 'Review student (input in code): ' + student['name'] + ', ID#: ' + student['student_id'] + ', Folder name:\'' + student['folder'] + '\'',
+                 '')
+    return feedback_for_file
+
+
+def resource_limit_prints(student: dict, limit: str):
+    """Prints necessary resource limit actions, limit is the RESOURCE_LIMITS key of the limit that was exceeded
+    """
+    description = RESOURCE_LIMIT_DESCRIPTIONS.get(limit, limit)
+    feedback_for_file = f'Code used more {description} than allowed while grading' + '\n'
+    feedback_for_file += 'FURTHER REVIEW REQUIRED' + '\n'
+    review_print(student,
+                 f'Review student (over the {description} limit): ' + student['name'] + ', ID#: ' + student['student_id'] + ', Folder name:\'' + student['folder'] + '\'',
+                 '')
     return feedback_for_file
 
 
-def more_then_one_file_prints():
+def more_then_one_file_prints(student: dict):
     """Prints necessary actions if more than 1 valid file is submitted
     """
     feedback_for_file = 'Student has more than 1 file matching the possible submissions' + '\n' + \
                         'FURTHER REVIEW REQUIRED' + '\n'
-    print(
-        'Review student (more than 1 possible submission file): ' + name + ', ID#: ' + student_id + ', Folder name:\'' + folder + '\'',
-        file=original_stderr)
-    print(file=original_stderr)
+    review_print(student,
+                 'Review student (more than 1 possible submission file): ' + student['name'] + ', ID#: ' + student['student_id'] + ', Folder name:\'' + student['folder'] + '\'',
+                 '')
     return feedback_for_file
 
 
-def test_code_error_prints():
+def test_code_error_prints(student: dict):
     """Prints necessary test code error actions
     """
     feedback_for_file = 'Student has caused an error with the grading software' + '\n' + \
                         'FURTHER REVIEW REQUIRED' + '\n'
-    print(
-        'Review student (grading code created an error): ' + name + ', ID#: ' + student_id + ', Folder name:\'' + folder + '\'',
-        file=original_stderr)
-    print(file=original_stderr)
+    review_print(student,
+                 'Review student (grading code created an error): ' + student['name'] + ', ID#: ' + student['student_id'] + ', Folder name:\'' + student['folder'] + '\'',
+                 '')
     return feedback_for_file
 
 
 def list_files(directory: str) -> list:
     """
     Returns a list of all the files held in a given directory
-    that is contained in the same folder as the script is in.
+    that is contained in the folder being graded (the working directory, like the zip files).
     """
-    path = os.path.join(os.path.dirname(__file__), directory)
-    # Use os.path.dirname(__file__) to get the directory of the script,
-    # and os.path.join to create a path to the desired directory
+    path = os.path.abspath(directory)
     files = []
     for file in os.listdir(path):
         if os.path.isfile(os.path.join(path, file)):
@@ -351,28 +1973,47 @@ def filter_py_files(file_list: list) -> list:
     return filtered_list
 
 
-def copy_files_to_grading_folder(folder_name: str, files_in_folder: list) -> list:
+def create_student_workspace(root: str, py_sources: dict) -> str:
     """
-    Given a folder name, copy all files in that folder to a new folder
-    named 'GRADING_MATERIAL_LOCATION' in the same directory as the original folder.
-    Raise an error if the grading folder contains a file with the same name as a file
-    in the original folder.
+    Create a private scratch folder for a student inside root with a copy of GRADING_MATERIAL_LOCATION
+    (so files the student's code writes or changes never reach the grading material or other students)
+    and the student's python files (py_sources, file name -> contents) written in.
+    Raise an error if the grading folder contains a file with the same name as a student file.
+    Returns the path of the workspace.
     """
-    folder_path = os.path.join(os.getcwd(), folder_name)
     grading_folder_path = os.path.join(os.getcwd(), GRADING_MATERIAL_LOCATION)
+    workspace = tempfile.mkdtemp(prefix='student_', dir=root)
+
+    # Copy the grading material, skipping compiled files so students never share them
+    for filename in os.listdir(grading_folder_path):
+        if filename != '__pycache__':
+            copy_material(os.path.join(grading_folder_path, filename), os.path.join(workspace, filename))
+
+    # Write the student's files to the workspace
+    for filename, contents in py_sources.items():
+        destination_path = os.path.join(workspace, filename)
+        if os.path.lexists(destination_path):
+            raise ValueError(f'File {filename} already exists in the grading folder')
+        with open(destination_path, 'wb') as file:
+            file.write(contents)
+    return workspace
+
+
+def copy_material(source_path: str, destination_path: str):
+    """Copies a grading material file or folder (without its compiled files) to destination_path"""
+    if os.path.isdir(source_path):
+        shutil.copytree(source_path, destination_path, ignore=shutil.ignore_patterns('__pycache__'))
+    else:
+        shutil.copyfile(source_path, destination_path)
 
-    # Create the grading folder if it doesn't already exist
-    if not os.path.exists(grading_folder_path):
-        os.mkdir(grading_folder_path)
 
-    # Copy all files from the original folder to the grading folder
-    for filename in files_in_folder:
-        source_path = os.path.join(folder_path, filename)
-        if os.path.isfile(source_path):
-            destination_path = os.path.join(grading_folder_path, filename)
-            if os.path.exists(destination_path):
-                raise ValueError(f'File {filename} already exists in the grading folder')
-            shutil.copyfile(source_path, destination_path)
+def scratch_location():
+    """Returns the folder to create student workspaces in, None means the system temporary folder"""
+    if SCRATCH_LOCATION is not None:
+        return SCRATCH_LOCATION
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
 
 
 def format_keys_dict(d: dict) -> str:
@@ -393,93 +2034,107 @@ def format_keys_dict(d: dict) -> str:
         return f"{other_keys}, or {last_key}"
 
 
-def change_to_grading_dir(current_dir: str):
-    """Change the current working directory to the directory specified by the global constant GRADING_MATERIAL_LOCATION."""
-    new_dir = os.path.join(current_dir, GRADING_MATERIAL_LOCATION)
-    os.chdir(new_dir)
-
-
-def delete_files(file_names: list, supress_errors=False):
+def get_zip_filenames(exclude_prefix: str) -> list:
     """
-    Deletes all files with the names specified in a list from the current working directory.
-    Throws an error if a file name from the list is not found in the directory.
+    Returns the names of the zip files to grade, sorted by their original name so the
+    feedback zip numbers stay the same when a run is resumed
     """
-    cwd = os.getcwd()
-    for name in file_names:
-        if not os.path.isfile(os.path.join(cwd, name)) and not supress_errors:
-            raise FileNotFoundError(f"File '{name}' not found in directory '{cwd}'.")
-        if not supress_errors:
-            os.remove(os.path.join(cwd, name))
-        else:
-            shutil.rmtree(os.path.join(cwd, name))
-
-
-def delete_files_except(directory_path: str, keep_files: list):
-    for file_name in os.listdir(directory_path):
-        file_path = os.path.join(directory_path, file_name)
-        if os.path.isfile(file_path) and file_name not in keep_files:
-            os.remove(file_path)
-
-
-def zip_folders(folder_names: list, zip_name: str, root_files: list = None) -> str:
-    if not zip_name.endswith('.zip'):
-        zip_name += '.zip'
-    zip_path = os.path.join(os.getcwd(), zip_name)
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for folder_name in folder_names:
-            folder_path = os.path.join(os.getcwd(), folder_name)
-            if os.path.isdir(folder_path):
-                for root, dirs, files in os.walk(folder_path):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        rel_path = os.path.relpath(file_path, folder_path)
-                        zipf.write(file_path, os.path.join(folder_name, rel_path))
-                shutil.rmtree(folder_path)
-        if root_files:
-            for file in root_files:
-                if os.path.isfile(file):
-                    zipf.write(file, os.path.basename(file))
-                    os.remove(file)
-    return zip_path
-
-
-def get_zip_filenames(exclude_prefix: str) -> list:
     zip_filenames = []
     for filename in os.listdir():
         if filename.endswith('.zip') and not filename.startswith(exclude_prefix + '-'):
             zip_filenames.append(filename)
-    return zip_filenames
+    return sorted(zip_filenames, key=original_zip_name)
+
+
+def original_zip_name(zip_file_name: str) -> str:
+    """Returns the name of a zip file before read_single_zip added the DO_NOT_UPLOAD_ prefix"""
+    if zip_file_name.startswith(DO_NOT_UPLOAD_PREFIX):
+        return zip_file_name[len(DO_NOT_UPLOAD_PREFIX):]
+    return zip_file_name
 
 
-def unzip_single_zip(zip_file_name: str, index_file_name: str) -> list:
+def read_single_zip(zip_file_name: str, index_file_name: str) -> tuple:
     """
-    Extracts all files and folders from a zipped folder to a destination directory.
-    The extracted folder will be renamed with a "DO_NOT_UPLOAD_" prefix.
-    Returns list of all folders extracted (assuming the only non folder file is global variable INDEX_FILE_NAME)
+    Reads the student folders of a zip file without extracting it, only the python files are read.
+    The zip file will be renamed with a "DO_NOT_UPLOAD_" prefix. Runs in the batch loader thread.
+    Returns the new name of the zip file and a dictionary of every student folder (sorted, assuming the only
+    non folder file is global variable INDEX_FILE_NAME) to its files: {'files': names of the files directly
+    inside the folder, 'py_sources': python file name -> contents}
     """
-    extracted_folder = os.path.splitext(zip_file_name)[0] + '.zip'
-    extracted_folder_with_prefix = extracted_folder if extracted_folder.startswith(
-        "DO_NOT_UPLOAD_") else f"DO_NOT_UPLOAD_{extracted_folder}"
+    zip_file_name_with_prefix = DO_NOT_UPLOAD_PREFIX + original_zip_name(zip_file_name)
+
+    submissions = {}
+    with run_report.stage('read zip', original_zip_name(zip_file_name)), zipfile.ZipFile(zip_file_name, 'r') as zip_ref:
+        for member in zip_ref.infolist():
+            if member.filename == index_file_name or member.is_dir():
+                continue
+            folder_name, _, file_name = member.filename.partition('/')
+            submission = submissions.setdefault(folder_name, {'files': [], 'py_sources': {}})
+            if '/' in file_name:  # files in sub folders are never graded
+                continue
+            submission['files'].append(file_name)
+            if file_name.endswith('.py'):
+                submission['py_sources'][file_name] = zip_ref.read(member)
 
-    with zipfile.ZipFile(zip_file_name, 'r') as zip_ref:
-        zip_ref.extractall('.')
-        unzipped_files = zip_ref.namelist()
+    os.rename(zip_file_name, zip_file_name_with_prefix)
+
+    return zip_file_name_with_prefix, dict(sorted(submissions.items()))
 
-    unzipped_folders = []
-    for file_name in unzipped_files:
-        if '/' in file_name:
-            folder_name = file_name.split('/')[0]
-            if folder_name not in unzipped_folders:
-                unzipped_folders.append(folder_name)
-        else:
-            if file_name not in unzipped_folders:
-                unzipped_folders.append(file_name)
-    unzipped_folders.remove(index_file_name)
 
-    os.rename(extracted_folder, extracted_folder_with_prefix)
-    print(f"{zip_file_name} has been unzipped and renamed to {extracted_folder_with_prefix} successfully.")
+class FeedbackZip:
+    """
+    Feedback zip of one batch, written while grading: every student folder of the submission zip is copied
+    straight into it with feedback added to the top of the graded file, no student files are extracted to disk.
+    Only used by one thread at a time (the feedback writer).
+    """
 
-    return list(set(unzipped_folders))
+    def __init__(self, submission_zip_name: str, zip_name: str, index_file_name: str):
+        if not zip_name.endswith('.zip'):
+            zip_name += '.zip'
+        self.zip_name = zip_name
+        self.index_file_name = index_file_name
+        self.submission_zip = zipfile.ZipFile(submission_zip_name, 'r')
+        self.members = {}  # student folder -> its files in the submission zip
+        for member in self.submission_zip.infolist():
+            if not member.is_dir() and '/' in member.filename:
+                self.members.setdefault(member.filename.split('/')[0], []).append(member)
+        self.zip_file = zipfile.ZipFile(zip_name, 'w', zipfile.ZIP_DEFLATED)
+        self.finished = False
+
+    def add_student(self, folder: str, feedback_file: tuple = None):
+        """
+        Copies a student's folder into the feedback zip, feedback_file (graded file name, new file name, contents
+        from add_feedback_text) replaces the graded file if the student was graded
+        """
+        with run_report.stage('feedback zip', folder):
+            for member in self.members.get(folder, []):
+                file_name = member.filename[len(folder) + 1:]
+                if feedback_file is not None and file_name == feedback_file[0]:
+                    file_name, contents = feedback_file[1:]
+                else:
+                    contents = self.submission_zip.read(member)
+                self.write(folder + '/' + file_name, contents, member.date_time)
+
+    def write(self, name: str, contents: bytes, date_time: tuple):
+        info = zipfile.ZipInfo(name, date_time)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        self.zip_file.writestr(info, contents)
+
+    def close(self):
+        """Adds the index file and finishes the feedback zip"""
+        with run_report.stage('feedback zip', self.zip_name):
+            index_info = self.submission_zip.getinfo(self.index_file_name)
+            self.write(self.index_file_name, self.submission_zip.read(index_info), index_info.date_time)
+            self.zip_file.close()
+        self.submission_zip.close()
+        self.finished = True
+
+    def discard(self):
+        """Removes the feedback zip if it is unfinished"""
+        if not self.finished:
+            self.zip_file.close()
+            self.submission_zip.close()
+            os.remove(self.zip_name)
 
 
 def list_to_string(lst: list) -> str:
@@ -503,186 +2158,978 @@ def list_to_string(lst: list) -> str:
 
 def handle_signal(signal_num, frame):
     # Code to execute when the SIGINT signal is received
-    print("Stopping the code...")
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # a second ctrl+C would stop the students from being stopped
+    print("Stopping the code... (students graded so far are saved, run again with --resume to continue)")
     # Code to perform some final steps before stopping the code
+    stop_grading()
     os.chdir(original_dir)
-    delete_files_except(GRADING_MATERIAL_LOCATION, original_grading_material_files)
-    delete_files([INDEX_FILE_NAME])
-    delete_files(folders, supress_errors=True)
+    if workspace_root is not None:
+        shutil.rmtree(workspace_root, ignore_errors=True)
+    stop_batch_pipeline()
+    if results_database is not None:
+        results_database.close()
 
     sys.exit(0)
 
 
-signal.signal(signal.SIGINT, handle_signal)
+def stop_grading():
+    """
+    Stops grading students: no student process starts once grading_stopped is set and the running ones are
+    killed (see wait_in_phases), the threads grading them are waited for before the forkservers are closed
+    so none of them uses a forkserver after it is gone. Nothing graded while stopping is cached or journaled.
+    """
+    grading_stopped.set()
+    for pool in (grading_pool, shard_pool):
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+    close_fork_servers()
 
-######################################################################################################################
-######################################################################################################################
-######################################################################################################################
-######################################################################################################################
 
+def stop_batch_pipeline():
+    """Stops the batch loader and feedback writer threads and removes feedback zips they did not finish"""
+    for executor in (batch_loader, feedback_writer):
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+    for zip_file in feedback_zips:
+        zip_file.discard()
 
-# main script
-# Find zip files
-brightspace_submission_download_zip_names = get_zip_filenames(FEEDBACK_ZIP_FOLDER_NAME)
-print(f"found {len(brightspace_submission_download_zip_names)} zip folders to grade")
-print(f"grading zip folders: {list_to_string(brightspace_submission_download_zip_names)}")
-scores = []
 
-folder_counter = 0
-issues_counter = 0
-missing_names_counter = 0
-wrong_file_names_counter = 0
-syntax_error_counters = 0
+class ResultCache:
+    """
+    Results of name/ID checks and grading runs keyed on a hash of everything that decides them (see
+    submission_key). Kept on disk between runs, where the least recently used results are removed once
+    the cache is bigger than max_bytes, and in memory for the current run so byte identical submissions
+    are only graded once. Results with a timeout or resource limit (both depend on how busy the computer was)
+    or a student process killed by a signal, and results computed while the run is stopping, are only kept
+    for the current run.
+    """
 
-#TODO test
-grade_stats_dictionary = {key: [] for key in LAB_NAME_GRADING_SOFTWARE_INDEX.keys()}
-#TODO test
+    def __init__(self, location: str, max_bytes: int):
+        self.location = location
+        self.max_bytes = max_bytes
+        os.makedirs(location, exist_ok=True)
+        self.lock = threading.Lock()
+        self.run_results = {}  # key -> (folder graded first, entry)
+        self.pending = {}  # key -> threading.Event set once the thread grading it is done
+
+    def get_or_compute(self, key: str, folder: str, usable, compute) -> tuple:
+        """
+        Returns (entry, folder of the identical submission it came from or None) for key, calling compute() for a
+        new entry if neither this run nor the disk has one that usable(entry) accepts.
+        Waits if another thread is already computing the same key.
+        """
+        while True:
+            with self.lock:
+                if key in self.run_results:
+                    first_folder, entry = self.run_results[key]
+                    if usable(entry):
+                        return entry, first_folder
+                    break
+                if key not in self.pending:
+                    self.pending[key] = threading.Event()
+                    break
+                event = self.pending[key]
+            event.wait()
 
-# Save original files of grading material folder to avoid modification in case of code failure
-original_grading_material_files = list_files(GRADING_MATERIAL_LOCATION)
-original_dir = os.getcwd()
-for i in range(len(brightspace_submission_download_zip_names)):
-    # Unzip student folders and get their names list
-    folders = unzip_single_zip(brightspace_submission_download_zip_names[i], INDEX_FILE_NAME)
-    folder_counter += len(folders)
-
-    print(
-        f"Beginning grading folder '{brightspace_submission_download_zip_names[i]}', detected {len(folders)} students")
-    # Grade each file
-    for folder in folders:
-        # Get name and ID
-        if PRINT_ALL_STUDENTS:
-            print(f"grading folder '{folder}' .......................")
-        name, student_id = parse_name_and_student_id(folder, fix_order=FIX_NAME_ORDER)
-
-        try:  # In case an error is caused here, let marker know the student who caused it
-            files_in_student_folder = list_files(folder)  # list of files in student folder
-            py_files_without_extension = filter_py_files(
-                files_in_student_folder)  # python files without their extension
-            py_files_with_extension = [file_name + ".py" for file_name in py_files_without_extension]
-
-            # Begin writing feedback
-            feedback_for_student = f"{name}\n{student_id}\n\ngrading software summary:\n"
-
-            # Check if file is one of the possible valid names
+        try:
+            with run_report.stage('cache lookup', folder):
+                entry = self.load(key)
+            if entry is None or not usable(entry):
+                entry = compute()
+                self.save(key, entry)
+            with self.lock:
+                self.run_results[key] = (folder, entry)
+        finally:
+            with self.lock:
+                event = self.pending.pop(key, None)
+            if event is not None:
+                event.set()
+        return entry, None
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.location, key + '.json')
+
+    def load(self, key: str):
+        """Returns the entry saved on disk for key (marking it as recently used), None if there is none"""
+        try:
+            with open(self.path(key), encoding='utf-8') as file:
+                entry = json.load(file)
+            os.utime(self.path(key))
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key: str, entry: dict):
+        """
+        Saves entry on disk unless it timed out, ran into a resource limit or had a student process killed by a
+        signal, or the run is stopping (the student processes may have been stopped with it)
+        """
+        if entry['given_id'] in ('TimeoutExpired', 'ResourceLimitExceeded') or entry['grading'] == 'TimeoutExpired' \
+                or isinstance(entry['grading'], dict) and 'resource_limit' in entry['grading'] \
+                or entry.get('killed_by_signal') or grading_stopped.is_set():
+            return
+        temporary_path = self.path(key) + f'.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump(entry, file)
+        os.replace(temporary_path, self.path(key))
+
+    def trim(self):
+        """Removes the least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for dir_entry in os.scandir(self.location):
+            if dir_entry.name.endswith('.json'):
+                stat = dir_entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            os.remove(path)
+            total_size -= size
+
+
+def hash_folder(directory: str, left_out: set = frozenset()) -> str:
+    """
+    Returns a hash of the names and contents of every file in directory (and its sub folders),
+    but the files whose path relative to directory is in left_out
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        for file_name in sorted(files):
+            file_path = os.path.join(root, file_name)
+            relative_path = os.path.relpath(file_path, directory)
+            if relative_path in left_out:
+                continue
+            digest.update(relative_path.encode() + b'\0')
+            with open(file_path, 'rb') as file:
+                digest.update(hashlib.sha256(file.read()).digest())
+    return digest.hexdigest()
+
+
+def material_hash(lab_name: str) -> str:
+    """
+    Returns a hash of the grading material a lab is graded with: its own grading script and every file that
+    is not the grading script of another lab (data files, modules the grading scripts import...), so changing
+    the grading script of one lab keeps the cached results of the others
+    """
+    other_scripts = {grading_software + '.py' for grading_software in LAB_NAME_GRADING_SOFTWARE_INDEX.values()}
+    other_scripts.discard(LAB_NAME_GRADING_SOFTWARE_INDEX[lab_name] + '.py')
+    return hash_folder(GRADING_MATERIAL_LOCATION, other_scripts)
+
+
+def submission_key(file_to_grade: str, py_sources: dict) -> str:
+    """
+    Returns the result cache key of a submission: a hash of the student's python files, the grading material
+    of its lab (see material_hash), the settings that change results (SCORE_CODE, TIMEOUT, the lab's resource
+    limits and test shards, MAX_OUTPUT_KB, TEAM_NAME_CHECK) and RESULT_CACHE_FORMAT. The calibrated timeouts are
+    left out, they may round to another value on the next run and results that timed out are not kept anyway.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([file_to_grade, LAB_NAME_GRADING_SOFTWARE_INDEX[file_to_grade],
+                              grading_material_hashes[file_to_grade],
+                              SCORE_CODE, TIMEOUT, resource_limits_of(file_to_grade), test_shards_of(file_to_grade),
+                              MAX_OUTPUT_KB, TEAM_NAME_CHECK, RESULT_CACHE_FORMAT], sort_keys=True).encode())
+    for file_name in sorted(py_sources):
+        digest.update(file_name.encode() + b'\0')
+        digest.update(hashlib.sha256(py_sources[file_name]).digest())
+    return digest.hexdigest()
+
+
+def identity_passes(given_id: str, given_author: str, student_id: str) -> bool:
+    """Returns True if the name/ID check result lets the student be graded"""
+    return given_id == student_id and given_author not in ('', 'syntaxError', 'TimeoutExpired', 'InputInCode')
+
+
+def run_checks(folder: str, py_sources: dict, file_to_grade: str, student_id: str, root: str,
+               identity: tuple = None) -> tuple:
+    """
+    Runs the name/ID check and (if it passes) the grading of a student's file in a workspace of its own,
+    returns the given ID, author and grading run like get_id_author_and_grading_run. The name/ID check
+    is skipped if its result (identity) is already known from prescreen_submission.
+    """
+    # Copy the student's files into a workspace of their own
+    with run_report.stage('workspace', folder):
+        workspace = create_student_workspace(root, py_sources)
+    try:
+        if identity is not None:
+            with run_report.stage('grading', folder):
+                grading_run = grade(LAB_NAME_GRADING_SOFTWARE_INDEX[file_to_grade] + '.py', workspace,
+                                    timeouts_of(file_to_grade)[1], resource_limits_of(file_to_grade),
+                                    test_shards_of(file_to_grade))
+            return identity + (grading_run,)
+
+        if SINGLE_LAUNCH_GRADING and test_shards_of(file_to_grade) == 1:
+            with run_report.stage('identity check + grading', folder):
+                return get_id_author_and_grading_run(file_to_grade, workspace, student_id,
+                                                     check_team=TEAM_NAME_CHECK)
+
+        identity_timeout, grading_timeout = timeouts_of(file_to_grade)
+        with run_report.stage('identity check', folder):
+            given_id, given_author = get_id_and_author(file_to_grade, workspace, check_team=TEAM_NAME_CHECK,
+                                                       timeout=identity_timeout)
+        grading_run = None
+        if identity_passes(given_id, given_author, student_id):
+            with run_report.stage('grading', folder):
+                grading_run = grade(LAB_NAME_GRADING_SOFTWARE_INDEX[file_to_grade] + '.py', workspace,
+                                    grading_timeout, resource_limits_of(file_to_grade), test_shards_of(file_to_grade))
+        return given_id, given_author, grading_run
+    finally:
+        # the workspace is only needed while the student is being graded
+        with run_report.stage('workspace cleanup', folder):
+            shutil.rmtree(workspace, ignore_errors=True)
+
+
+def check_submission(student: dict, file_to_grade: str, root: str, identity: tuple = None) -> tuple:
+    """
+    Returns the given ID, author and grading run of a student's file (see run_checks), reusing the result
+    of a byte identical submission from this run or an earlier one when the result cache is on
+    """
+    folder, student_id, py_sources = student['folder'], student['student_id'], student['py_sources']
+    if result_cache is None:
+        return run_checks(folder, py_sources, file_to_grade, student_id, root, identity)
+
+    def usable(entry: dict) -> bool:  # an entry that skipped grading can't be used for a student that needs it
+        return entry['grading'] is not None or not identity_passes(entry['given_id'], entry['given_author'],
+                                                                   student_id)
+
+    def compute() -> dict:
+        thread_state.killed_by_signal = False
+        given_id, given_author, grading_run = run_checks(folder, py_sources, file_to_grade, student_id, root,
+                                                         identity)
+        if isinstance(grading_run, subprocess.TimeoutExpired):
+            grading = 'TimeoutExpired'
+        elif isinstance(grading_run, InputInCode):
+            grading = 'InputInCode'
+        elif isinstance(grading_run, ResourceLimitExceeded):
+            grading = {'resource_limit': grading_run.limit}
+        elif grading_run is not None:
+            grading = {'stdout': grading_run.stdout, 'result': grading_run.result}
+        else:
+            grading = None
+        entry = {'given_id': given_id, 'given_author': given_author, 'grading': grading}
+        if thread_state.killed_by_signal:
+            entry['killed_by_signal'] = True
+        return entry
+
+    with run_report.stage('cache lookup', folder):
+        key = submission_key(file_to_grade, py_sources)
+    entry, duplicate_of = result_cache.get_or_compute(key, folder, usable, compute)
+    if duplicate_of is not None and duplicate_of != folder:
+        student['duplicate_of'] = duplicate_of
+        review_print(student,
+                     'Review student (identical submission to folder \'' + duplicate_of + '\'): ' + student['name'] +
+                     ', ID#: ' + student_id + ', Folder name:\'' + folder + '\'',
+                     '')
+
+    if entry['grading'] == 'TimeoutExpired':
+        grading_run = subprocess.TimeoutExpired('result cache', TIMEOUT)
+    elif entry['grading'] == 'InputInCode':
+        grading_run = InputInCode()
+    elif entry['grading'] is not None and 'resource_limit' in entry['grading']:
+        grading_run = ResourceLimitExceeded(entry['grading']['resource_limit'])
+    elif entry['grading'] is not None:
+        grading_run = subprocess.CompletedProcess(['result cache'], 0, entry['grading']['stdout'], '')
+        grading_run.result = entry['grading']['result']
+    else:
+        grading_run = None
+    return entry['given_id'], entry['given_author'], grading_run
+
+
+def grade_student(student: dict, root: str) -> dict:
+    """
+    Grades a single student (whose 'files' and 'py_sources' were read by read_single_zip) inside its own
+    workspace (created in root). Fills in the student's
+    'score', 'feedback', 'file_to_grade' and 'outcome' and returns the student. Safe to run in parallel,
+    messages for the marker are saved in student['console'] instead of printed.
+    """
+    folder, name, student_id = student['folder'], student['name'], student['student_id']
+    started = time.perf_counter()
+
+    files_in_student_folder = student['files']  # list of files in student folder
+    py_files_without_extension = filter_py_files(files_in_student_folder)  # python files without their extension
+
+    # Begin writing feedback
+    feedback_for_student = f"{name}\n{student_id}\n\ngrading software summary:\n"
+
+    # Check if file is one of the possible valid names
+    try:
+        file_to_grade = check_list_for_matching_key(py_files_without_extension)
+    except ValueError:
+        # TODO add more action in this case
+        more_then_one_file_prints(student)  # more than one VALID file exits
+        student.update(outcome='more_than_one_file', seconds=time.perf_counter() - started)
+        return student
+
+    if file_to_grade is not None:  # attempt to grade if name is valid
+
+        # Get ID and name and grade, check if this causes issues. Problems certain from reading the file alone
+        # are not run at all
+        identity = None
+        if PRESCREEN_SUBMISSIONS:
+            with run_report.stage('pre-screen', folder):
+                identity = prescreen_submission(student['py_sources'], file_to_grade)
+        if identity is not None and not identity_passes(identity[0], identity[1], student_id):
+            given_id, given_author, grading_run = identity + (None,)
+        else:
+            given_id, given_author, grading_run = check_submission(student, file_to_grade, root, identity)
+
+        # Check for errors
+        infinite_loop = given_id == 'TimeoutExpired' and given_author == 'TimeoutExpired' or \
+            isinstance(grading_run, subprocess.TimeoutExpired)
+        input_in_code = given_id == 'InputInCode' and given_author == 'InputInCode' or \
+            isinstance(grading_run, InputInCode)
+        if given_id == 'ResourceLimitExceeded':
+            exceeded = given_author
+        elif isinstance(grading_run, ResourceLimitExceeded):
+            exceeded = grading_run.limit
+        else:
+            exceeded = None
+        syntax_error = given_id == 'syntaxError' and given_author == 'syntaxError'
+        id_on_file_incorrect = given_id != student_id
+
+        # This one checks if the name is either missing or empty
+        name_on_file_missing = len(given_id) == 0 or len(given_author) == 0
+        if given_id not in ('syntaxError', 'TimeoutExpired', 'InputInCode', 'ResourceLimitExceeded'):
+            student.update(given_id=given_id, given_author=given_author)  # saved in the results database
+
+        # Act on errors if any, otherwise grade
+        if infinite_loop:
+            score = -1
+            outcome = 'infinite_loop'
+            feedback_for_student += infinite_loop_prints(student) + '\n'
+
+        elif input_in_code:
+            score = -1
+            outcome = 'input_in_code'
+            feedback_for_student += input_in_code_prints(student) + '\n'
+
+        elif exceeded is not None:
+            score = -1
+            outcome = 'resource_limit'
+            feedback_for_student += resource_limit_prints(student, exceeded) + '\n'
+
+        elif syntax_error:
+            score = 0
+            outcome = 'syntax_error'
+            feedback_for_student += 'Syntax error in code (0/10)' + '\n'
+
+        elif name_on_file_missing:
+            score = 0
+            outcome = 'missing_name'
+            feedback_for_student += 'No name or student ID in code (0/10)\n' + \
+                                    'You must define __author__ and __student_number__ !!\n'
+        elif id_on_file_incorrect:
+            score = -1  # files with the ID of another student are listed by the similarity check
+            outcome = 'id_mismatch'
+            feedback_for_student += mismatching_name_prints(student, given_id, given_author) + '\n'
+
+        else:
+            score, feedback_addition = score_grading_run(grading_run, student)
+            feedback_for_student += feedback_addition
+            outcome = 'graded'
+            if getattr(grading_run, 'result', None) is not None:
+                student['tests'] = {test['test']: test['outcome'] for test in grading_run.result['tests']}
+
+    else:  # if file is not a correct name
+        score = 0
+        outcome = 'wrong_file_name'
+        feedback_for_student = 'wrong file name: (0/10) -> should be ' + format_keys_dict(
+            LAB_NAME_GRADING_SOFTWARE_INDEX) + '\n'
+        file_to_grade = py_files_without_extension[0]
+
+    student.update(score=score, feedback=feedback_for_student, file_to_grade=file_to_grade, outcome=outcome,
+                   seconds=time.perf_counter() - started)
+    return student
+
+
+def timeouts_of(lab_name: str) -> tuple:
+    """Returns the (name/ID check, grading) timeouts of a lab, TIMEOUT for both if it was not calibrated"""
+    return lab_timeouts.get(lab_name, (TIMEOUT, TIMEOUT))
+
+
+def round_up_timeout(seconds: float) -> float:
+    """
+    Returns seconds times TIMEOUT_MULTIPLIER rounded up to 0.5, 1, 2, 5, 10, 20, 50... and kept between
+    MIN_TIMEOUT and MAX_TIMEOUT, the rounding keeps the same timeouts between runs
+    """
+    seconds = min(max(seconds * TIMEOUT_MULTIPLIER, MIN_TIMEOUT), MAX_TIMEOUT)
+    step = 0.1
+    while True:
+        for multiple in (1, 2, 5):
+            if step * multiple >= seconds - 1e-9:
+                return min(round(step * multiple, 1), MAX_TIMEOUT)
+        step *= 10
+
+
+def calibrate_timeouts(reference_location: str, root: str) -> dict:
+    """
+    Runs the name/ID check and grading script of every lab that has a solution in reference_location
+    TIMEOUT_CALIBRATION_RUNS times (in a workspace created in root, the same way students are run) and returns
+    lab name -> (name/ID check timeout, grading timeout) based on the slowest runs. Labs whose reference
+    solution does not get a score are left out, they use TIMEOUT.
+    """
+    reference_sources = {}
+    for file_name in list_files(reference_location):
+        if file_name.endswith('.py'):
+            with open(os.path.join(reference_location, file_name), 'rb') as file:
+                reference_sources[file_name] = file.read()
+
+    timeouts = {}
+    for lab_name, lab_grading_software_name in LAB_NAME_GRADING_SOFTWARE_INDEX.items():
+        if lab_name + '.py' not in reference_sources:
+            continue
+        workspace = create_student_workspace(root, reference_sources)
+        try:
+            identity_times, grading_times = [], []
+            for run in range(TIMEOUT_CALIBRATION_RUNS + 1):  # the first run only warms up the forkserver
+                with run_report.stage('timeout calibration', lab_name) as record:
+                    given_id, _ = get_id_and_author(lab_name, workspace, TEAM_NAME_CHECK, timeout=MAX_TIMEOUT)
+                with run_report.stage('timeout calibration', lab_name) as grading_record:
+                    grading_run = grade(lab_grading_software_name + '.py', workspace, MAX_TIMEOUT,
+                                        resource_limits_of(lab_name), test_shards_of(lab_name))
+                if run > 0:
+                    identity_times.append(record['wall'])
+                    grading_times.append(grading_record['wall'])
+                if given_id in ('syntaxError', 'TimeoutExpired', 'InputInCode', 'ResourceLimitExceeded') or \
+                        getattr(grading_run, 'result', None) is None:
+                    print(f"reference solution of {lab_name} did not get a score, using TIMEOUT for it",
+                          file=original_stderr)
+                    break
+            else:
+                timeouts[lab_name] = (round_up_timeout(max(identity_times)), round_up_timeout(max(grading_times)))
+        finally:
+            shutil.rmtree(workspace, ignore_errors=True)
+    return timeouts
+
+
+def load_journal(journal_path: str) -> dict:
+    """
+    Returns the students saved in the journal keyed by (original zip name, folder),
+    a half written last line (the run was killed while saving it) is ignored
+    """
+    journaled_students = {}
+    if not os.path.isfile(journal_path):
+        return journaled_students
+    with open(journal_path, encoding='utf-8') as journal:
+        for line in journal:
             try:
-                file_to_grade = check_list_for_matching_key(py_files_without_extension)
+                record = json.loads(line)
             except ValueError:
-                # TODO add more action in this case
-                feedback_for_student += more_then_one_file_prints() + '\n'  # more than one VALID file exits
                 continue
+            journaled_students[(record['zip'], record['folder'])] = record
+    return journaled_students
+
+
+def save_to_journal(journal, zip_file_name: str, student: dict, run_id: int = None):
+    """
+    Appends a graded student to the journal and flushes it so it survives a crash, with the run_id
+    of the run in RESULTS_DATABASE so --resume carries on with the same run
+    """
+    record = {'zip': original_zip_name(zip_file_name), 'run_id': run_id}
+    record.update((field, student.get(field)) for field in JOURNAL_FIELDS)
+    journal.write(json.dumps(record) + '\n')
+    journal.flush()
 
-            if file_to_grade is not None:  # attempt to grade if name is valid
 
-                # Copy and get a list of the files that were copied
-                copy_files_to_grading_folder(folder, py_files_with_extension)
+def print_stage_times(summary: dict):
+    """Prints how long each stage of the run took, the full report is saved to REPORT_FILE"""
+    print(f'-------stage times (seconds, full report in {REPORT_FILE})------')
+    print(f"{'stage':<26}{'count':>7}{'total':>9}{'p50':>9}{'p95':>9}{'max':>9}{'cpu':>9}")
+    for name, stage in summary['stages'].items():
+        wall = stage['wall']
+        print(f"{name:<26}{stage['count']:>7}{wall['total']:>9.3f}{wall['p50']:>9.3f}{wall['p95']:>9.3f}"
+              f"{wall['max']:>9.3f}{stage['cpu']['total'] + stage['child_cpu']['total']:>9.3f}")
+    print(f"run wall time: {summary['wall_time']:.2f}s\n")
 
-                # Get ID and name, check if this causes issues
-                change_to_grading_dir(original_dir)
-                given_id, given_author = get_id_and_author(file_to_grade, check_team=TEAM_NAME_CHECK)
 
-                # Check for errors
-                infinite_loop = given_id == 'TimeoutExpired' and given_author == 'TimeoutExpired'
-                syntax_error = given_id == 'syntaxError' and given_author == 'syntaxError'
-                id_on_file_incorrect = given_id != student_id
+def grade_statistics(scores: list, graded_scores: list) -> dict:
+    """
+    Returns the statistics of the scores of a group of students: the share of scores of 0 and -1 (needs review)
+    among all of them, and the mean, median, standard deviation, percentiles and histogram of the graded ones
+    """
+    statistics_of_group = {'students': len(scores), 'graded': len(graded_scores),
+                           'score_0_rate': round(scores.count(0) / len(scores), 4) if scores else None,
+                           'score_-1_rate': round(scores.count(-1) / len(scores), 4) if scores else None}
+    if not graded_scores:
+        return statistics_of_group
+    values = sorted(graded_scores)
+    statistics_of_group.update(mean=round(statistics.fmean(values), 2), median=statistics.median(values),
+                               stdev=round(statistics.pstdev(values), 2), min=values[0], max=values[-1],
+                               percentiles={percent: percentile(values, percent) for percent in (10, 25, 75, 90)},
+                               histogram=histogram(values, GRADE_HISTOGRAM_BINS))
+    return statistics_of_group
+
+
+def histogram(sorted_values: list, bins: int) -> dict:
+    """Returns the edges of equal width bins from the lowest to the highest value and how many values are in each"""
+    low, high = sorted_values[0], sorted_values[-1]
+    if low == high:
+        return {'edges': [low, high], 'counts': [len(sorted_values)]}
+    width = (high - low) / bins
+    counts = [0] * bins
+    for value in sorted_values:
+        counts[min(int((value - low) / width), bins - 1)] += 1  # the highest value goes in the last bin
+    return {'edges': [round(low + width * i, 4) for i in range(bins + 1)], 'counts': counts}
+
+
+def grade_statistics_report(grade_records: list) -> dict:
+    """
+    Returns the grade_statistics of every lab (and all labs together) for the whole run and for each zip, the labs
+    of a zip also have the difference between their mean and the mean of the run
+    """
+    groups = {}  # (zip name or None for the run, lab name or 'all labs') -> (scores, graded scores)
+    for zip_name, lab_name, score, graded in grade_records:
+        for group in ((None, 'all labs'), (None, lab_name), (zip_name, 'all labs'), (zip_name, lab_name)):
+            if group[1] is not None:
+                scores, graded_scores = groups.setdefault(group, ([], []))
+                scores.append(score)
+                if graded:
+                    graded_scores.append(score)
+    for lab_name in LAB_NAME_GRADING_SOFTWARE_INDEX:  # labs nobody submitted are reported too
+        groups.setdefault((None, lab_name), ([], []))
+
+    report = {'run': {}, 'zips': {}}
+    for (zip_name, lab_name), (scores, graded_scores) in groups.items():
+        if zip_name is None:
+            report['run'][lab_name] = grade_statistics(scores, graded_scores)
+    for (zip_name, lab_name), (scores, graded_scores) in groups.items():
+        if zip_name is not None:
+            statistics_of_group = grade_statistics(scores, graded_scores)
+            run_mean = report['run'][lab_name].get('mean')
+            if 'mean' in statistics_of_group and run_mean is not None:
+                statistics_of_group['mean_difference'] = round(statistics_of_group['mean'] - run_mean, 2)
+            report['zips'].setdefault(zip_name, {})[lab_name] = statistics_of_group
+    return report
+
+
+def print_grade_statistics(run_statistics: dict):
+    """Prints the statistics of each lab for the whole run, the full report is saved to GRADE_STATISTICS_FILE"""
+    print('function name\t:\taverage grade\tmedian\tstdev\tgraded\tscore 0\tscore -1')
+    for lab_name in LAB_NAME_GRADING_SOFTWARE_INDEX:
+        lab_statistics = run_statistics[lab_name]
+        rates = '\t'.join('-' if rate is None else f'{rate:.0%}' for rate in (lab_statistics['score_0_rate'],
+                                                                          lab_statistics['score_-1_rate']))
+        counts = f"{lab_statistics['graded']}/{lab_statistics['students']}"
+        if lab_statistics['graded']:
+            print(f"{lab_name}: {lab_statistics['mean']}\t{lab_statistics['median']}\t{lab_statistics['stdev']}\t"
+                  f"{counts}\t{rates}")
+        else:
+            print(f"{lab_name}: no graded students\t\t\t{counts}\t{rates}")
+
+
+def print_hardest_tests(test_matrices: dict):
+    """Prints the tests failed by the most students in each lab"""
+    print('-------most failed tests------')
+    for lab_name, test_matrix in test_matrices.items():
+        for test, failed, ran in test_matrix.hardest_tests()[:HARDEST_TESTS_PRINTED]:
+            if failed:
+                print(f"{lab_name}: {test} failed by {failed}/{ran} ({failed / ran:.0%})")
+
+
+def parse_arguments(argv: list = None) -> argparse.Namespace:
+    """Reads the command line options, defaults come from the GENERAL CONDITIONS section"""
+    parser = argparse.ArgumentParser(description='Batch grade brightspace submissions')
+    parser.add_argument('--jobs', type=int, default=JOBS,
+                        help='number of students graded at once (default: %(default)s)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted run, students saved in JOURNAL_FILE are not graded again')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='grade every student again instead of reusing results saved in RESULT_CACHE_LOCATION')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='save a timeline of the run as a chrome trace (chrome://tracing or ui.perfetto.dev)')
+    parser.add_argument('--config', metavar='FILE',
+                        help='grade several lab folders in one run, the labs share the --jobs student processes')
+    parser.add_argument('--lab-settings', help=argparse.SUPPRESS)  # used internally by --config, JSON settings
+    parser.add_argument('--jobserver', nargs=2, type=int, help=argparse.SUPPRESS)  # used internally by --config
+    parser.add_argument('--user-processes', type=int, help=argparse.SUPPRESS)  # used internally by --config
+    return parser.parse_args(argv)
+
+
+def read_lab_configs(config_path: str) -> list:
+    """
+    Reads a --config file, a JSON list of labs (or {"labs": [...]}) such as
+    [{"folder": "lab 3", "LAB_NAME_GRADING_SOFTWARE_INDEX": {...}, "TIMEOUT": 5}, {"folder": "lab 4"}]
+    where each lab names its folder, optionally a "name" shown before its messages, and any of the settings in
+    LAB_CONFIG_SETTINGS (the others come from this file). Stops the run if the file is not valid.
+    """
+    try:
+        with open(config_path, encoding='utf-8') as file:
+            labs = json.load(file)
+    except (OSError, ValueError) as error:
+        sys.exit(f'Could not read the config file {config_path}: {error}')
+    if isinstance(labs, dict):
+        labs = labs.get('labs')
+    if not isinstance(labs, list) or not labs:
+        sys.exit(f'The config file {config_path} must hold a list of labs')
+    config_folder = os.path.dirname(os.path.abspath(config_path))
+    names = set()
+    for lab in labs:
+        if not isinstance(lab, dict) or not isinstance(lab.get('folder'), str):
+            sys.exit(f'Every lab of {config_path} needs a "folder": {lab}')
+        unknown = set(lab) - {'folder', 'name'} - set(LAB_CONFIG_SETTINGS)
+        if unknown:
+            sys.exit(f'Unknown settings for lab {lab["folder"]} in {config_path}: {list_to_string(sorted(unknown))}')
+        lab['folder'] = os.path.join(config_folder, lab['folder'])  # folders are relative to the config file
+        if not os.path.isdir(lab['folder']):
+            sys.exit(f'The folder of lab {lab["folder"]} does not exist')
+        lab.setdefault('name', os.path.basename(os.path.normpath(lab['folder'])))
+        if lab['name'] in names:
+            sys.exit(f'Two labs of {config_path} are named {lab["name"]}')
+        names.add(lab['name'])
+    return labs
+
+
+def grade_labs(labs: list, args: argparse.Namespace) -> int:
+    """
+    Grades the labs of a --config file at the same time, each in its own process running this script in the
+    lab's folder. The labs share one pool of --jobs student processes (tokens in a pipe, like make's jobserver),
+    so a lab with few students left does not leave workers idle. Returns the worst exit code of the labs.
+    """
+    job_pipe = None
+    if hasattr(os, 'fork'):
+        job_pipe = os.pipe()
+        os.write(job_pipe[1], b'+' * max(1, args.jobs))
+    else:  # no fd inheritance to share the pool with, the labs are graded one after the other
+        print('Labs are graded one after the other on this platform')
+    passed_options = [option for option, used in (('--resume', args.resume), ('--no-cache', args.no_cache)) if used]
+    lab_settings = [{key: value for key, value in lab.items() if key in LAB_CONFIG_SETTINGS} for lab in labs]
+    # the labs run at the same time, so each one leaves room in RLIMIT_NPROC for the others, this process and its
+    # output reader threads
+    user_processes = count_user_processes()
+    lab_processes = [grading_run_processes(args.jobs, settings) for settings in lab_settings]
+
+    def start(lab: dict, settings: dict, other_lab_processes: int) -> subprocess.Popen:
+        if RESULTS_DATABASE is not None:  # one database for every lab unless a lab names its own
+            settings.setdefault('RESULTS_DATABASE', os.path.abspath(RESULTS_DATABASE))
+        command = [sys.executable, os.path.abspath(__file__), '--lab-settings', json.dumps(settings),
+                   '--jobs', str(args.jobs)] + passed_options
+        if user_processes is not None:
+            command += ['--user-processes', str(user_processes + len(labs) + other_lab_processes)]
+        if args.trace:
+            trace_folder, trace_name = os.path.split(os.path.abspath(args.trace))
+            command += ['--trace', os.path.join(trace_folder, f'{lab["name"]} {trace_name}')]
+        if job_pipe is not None:
+            command += ['--jobserver', str(job_pipe[0]), str(job_pipe[1])]
+        return subprocess.Popen(command, cwd=lab['folder'], pass_fds=job_pipe or (), stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, text=True, env=dict(os.environ, PYTHONUNBUFFERED='1'))
+
+    def show_output(lab: dict, process: subprocess.Popen):
+        for line in process.stdout:
+            print(f'[{lab["name"]}] {line}', end='', flush=True)
+
+    # ctrl+C reaches every lab process, each one saves its students and stops, this one only waits for them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    exit_codes = {}
+    running = []
+    for lab, settings, processes in zip(labs, lab_settings, lab_processes):
+        process = start(lab, settings, sum(lab_processes) - processes if job_pipe is not None else 0)
+        reader = threading.Thread(target=show_output, args=(lab, process), daemon=True)
+        reader.start()
+        running.append((lab, process, reader))
+        if job_pipe is None:
+            process.wait()
+    for lab, process, reader in running:
+        exit_codes[lab['name']] = process.wait()
+        reader.join()
+    if job_pipe is not None:
+        for fd in job_pipe:
+            os.close(fd)
+
+    print('\n-------labs------')
+    for name, exit_code in exit_codes.items():
+        print(f'{name}: {"done" if exit_code == 0 else f"failed (exit code {exit_code})"}')
+    return max(exit_codes.values(), key=abs)
 
-                # This one checks if the name is either missing or empty
-                name_on_file_missing = len(given_id) == 0 or len(given_author) == 0
 
-                # Act on errors if any, otherwise grade
-                if infinite_loop:
-                    score = -1
-                    issues_counter += 1
-                    feedback_for_student += infinite_loop_prints() + '\n'
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
 
-                elif syntax_error:
-                    score = 0
-                    syntax_error_counters += 1
-                    feedback_for_student += 'Syntax error in code (0/10)' + '\n'
 
-                elif name_on_file_missing:
-                    score = 0
-                    missing_names_counter += 1
-                    feedback_for_student += 'No name or student ID in code (0/10)\n' + \
-                                            'You must define __author__ and __student_number__ !!\n'
-                elif id_on_file_incorrect:
-                    score = -1  # TODO add simmiliarity
-                    issues_counter += 1
-                    feedback_for_student += mismatching_name_prints() + '\n'
+def main():
+    global original_grading_material_files, grading_pool, shard_pool, workspace_root, result_cache, grading_material_hashes, \
+        batch_loader, feedback_writer, lab_timeouts, user_process_limit, job_server, results_database
+
+    args = parse_arguments()
+    if args.config:
+        sys.exit(grade_labs(read_lab_configs(args.config), args))
+    if args.lab_settings:  # a lab of a --config run, its settings replace the ones at the top of this file
+        globals().update(json.loads(args.lab_settings))
+    if args.jobserver:
+        job_server = tuple(args.jobserver)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    # Find zip files
+    brightspace_submission_download_zip_names = get_zip_filenames(FEEDBACK_ZIP_FOLDER_NAME)
+    print(f"found {len(brightspace_submission_download_zip_names)} zip folders to grade")
+    print(f"grading zip folders: {list_to_string(brightspace_submission_download_zip_names)}")
+
+    folder_counter = 0
+    more_than_one_file_counter = 0
+    issues_counter = 0
+    missing_names_counter = 0
+    wrong_file_names_counter = 0
+    syntax_error_counters = 0
+    input_in_code_counter = 0
+    resource_limit_counter = 0
+    duplicates_counter = 0
+
+    grade_records = []  # (zip name, lab name or None for a wrong file name, score, graded) of every student
+    test_matrices = {lab_name: TestMatrix() for lab_name in LAB_NAME_GRADING_SOFTWARE_INDEX}
+    similarity_index = SimilarityIndex() if SIMILARITY_REPORT_FILE is not None else None
+
+    # The grading scripts are checked and compiled once, before any student is run
+    # RLIMIT_NPROC of the students is set above the processes/threads of the user (those of the other labs of a
+    # --config run included) and all those this run may have once its pools and forkservers are up
+    other_processes = args.user_processes if args.user_processes is not None else count_user_processes()
+    if other_processes is not None:
+        user_process_limit = other_processes + grading_run_processes(args.jobs)
+    prepare_grading_scripts()
+
+    # Every student is graded in a workspace of their own, so the grading material folder is never modified
+    original_grading_material_files = list_files(GRADING_MATERIAL_LOCATION)
+    workspace_root = tempfile.mkdtemp(prefix='grading_workspaces_', dir=scratch_location())
+    grading_material_hashes = {lab_name: material_hash(lab_name) for lab_name in LAB_NAME_GRADING_SOFTWARE_INDEX}
+
+    # Labs whose tests are split across processes run the other shards of every student on these threads
+    max_shards = max(test_shards_of(lab_name) for lab_name in LAB_NAME_GRADING_SOFTWARE_INDEX)
+    if max_shards > 1:
+        shard_pool = ThreadPoolExecutor(max_workers=(max_shards - 1) * args.jobs)
+
+    # Time limits of each lab come from how long its reference solution takes
+    if REFERENCE_SOLUTION_LOCATION is not None and os.path.isdir(REFERENCE_SOLUTION_LOCATION):
+        lab_timeouts = calibrate_timeouts(REFERENCE_SOLUTION_LOCATION, workspace_root)
+    print('timeouts (seconds)\tname/ID check\tgrading')
+    for lab_name in LAB_NAME_GRADING_SOFTWARE_INDEX:
+        identity_timeout, grading_timeout = timeouts_of(lab_name)
+        print(f"{lab_name}:\t{identity_timeout}\t{grading_timeout}" +
+              ('' if lab_name in lab_timeouts else '\t(TIMEOUT, not calibrated)'))
+    run_report.settings['timeouts'] = {lab_name: dict(zip(('identity check', 'grading'), timeouts_of(lab_name)))
+                                       for lab_name in LAB_NAME_GRADING_SOFTWARE_INDEX}
+    run_report.settings['forkserver preload'] = preload_modules
+    run_report.settings['resource limits'] = {lab_name: resource_limits_of(lab_name)
+                                              for lab_name in LAB_NAME_GRADING_SOFTWARE_INDEX}
+    if RESULT_CACHE_LOCATION is not None and not args.no_cache:
+        result_cache = ResultCache(RESULT_CACHE_LOCATION, RESULT_CACHE_MAX_MB * 1024 * 1024)
+    if args.jobs > 1:
+        grading_pool = ThreadPoolExecutor(max_workers=args.jobs)
+
+    # Every graded student is saved to the journal right away, --resume continues from it
+    journaled_students = load_journal(JOURNAL_FILE) if args.resume else {}
+    if args.resume:
+        print(f"resuming, {len(journaled_students)} students were already graded")
+    journal = open(JOURNAL_FILE, 'a' if args.resume else 'w', encoding='utf-8')
+    if RESULTS_DATABASE is not None:
+        interrupted_run = next(reversed(journaled_students.values()), {}).get('run_id')
+        results_database = ResultsDatabase(RESULTS_DATABASE, interrupted_run)
+
+    # csv header, a row is added as each student is done
+    field_names = ['OrgDefinedId', GRADES_CSV_HEADER, 'End-of-Line Indicator'] + (['Name'] if ADD_NAME_TO_CSV else [])
+    grades_csv = GradesCSV(SAVE_GRADES_TO, field_names)
+
+    # Batches are pipelined: the next zip is read while this one is graded and the feedback zip of the
+    # previous one is still being written
+    batch_loader = ThreadPoolExecutor(max_workers=1)
+    feedback_writer = ThreadPoolExecutor(max_workers=1)
+    feedback_writes = []
+    if brightspace_submission_download_zip_names:
+        next_batch = batch_loader.submit(read_single_zip, brightspace_submission_download_zip_names[0],
+                                         INDEX_FILE_NAME)
+
+    for i in range(len(brightspace_submission_download_zip_names)):
+        # Read student folders from the zip and get their names list, then start reading the next zip
+        zip_name = original_zip_name(brightspace_submission_download_zip_names[i])
+        renamed_zip_name, submissions = next_batch.result()
+        if i + 1 < len(brightspace_submission_download_zip_names):
+            next_batch = batch_loader.submit(read_single_zip, brightspace_submission_download_zip_names[i + 1],
+                                             INDEX_FILE_NAME)
+        print(f"{brightspace_submission_download_zip_names[i]} has been read and renamed to {renamed_zip_name} "
+              f"successfully.")
+        folders = list(submissions)
+        folder_counter += len(folders)
 
+        print(
+            f"Beginning grading folder '{brightspace_submission_download_zip_names[i]}', detected {len(folders)} students")
+        students = []
+        for folder in folders:
+            name, student_id = parse_name_and_student_id(folder, fix_order=FIX_NAME_ORDER)
+            student = {'folder': folder, 'name': name, 'student_id': student_id, 'console': []}
+            student.update(submissions[folder])
+            if (zip_name, folder) in journaled_students:  # graded before the run was interrupted
+                record = journaled_students[(zip_name, folder)]
+                student.update((field, record[field]) for field in JOURNAL_FIELDS if record.get(field) is not None)
+                student['journaled'] = True
+            students.append(student)
+
+        feedback_zip = FeedbackZip(renamed_zip_name, f"{FEEDBACK_ZIP_FOLDER_NAME}-{i + 1}", INDEX_FILE_NAME)
+        feedback_zips.append(feedback_zip)
+
+        # Grade each file, results are handled in folder order even when graded in parallel
+        if grading_pool is not None:
+            futures = [None if student.get('journaled') else grading_pool.submit(grade_student, student,
+                                                                                 workspace_root)
+                       for student in students]
+        for index, student in enumerate(students):
+            folder = student['folder']
+            if PRINT_ALL_STUDENTS:
+                print(f"grading folder '{folder}' .......................")
+
+            try:  # In case an error is caused here, let marker know the student who caused it
+                if student.get('journaled'):
+                    pass
+                elif grading_pool is not None:
+                    futures[index].result()
                 else:
-                    score, feedback_addition = grade(LAB_NAME_GRADING_SOFTWARE_INDEX[file_to_grade] + '.py')
-                    feedback_for_student += feedback_addition
-                    issues_counter += 1 if score == -1 else 0  # in case grading software caused an issue
-                    # TODO check back
-                    if score != -1:
-                        grade_stats_dictionary[file_to_grade].append(score)
-                    # TODO check back
-                # delete files from grading material folder and go back outside of it
-                delete_files(py_files_with_extension)
-                os.chdir(original_dir)
-
-
-            else:  # if file is not a correct name
-                score = 0
+                    grade_student(student, workspace_root)
+            except Exception as e:
+                # In case of bug that was not caught
+                stop_grading()
+                shutil.rmtree(workspace_root, ignore_errors=True)
+                stop_batch_pipeline()
+                journal.close()
+                grades_csv.close()
+                if results_database is not None:
+                    results_database.close()
+
+                print(f'ERROR due to folder \'{folder}\' \nCONTACT', __maintainer__, 'at:', __email__,
+                      '\nStudents graded so far are saved, run again with --resume once the problem is fixed',
+                      file=original_stderr)
+                print(e, file=original_stderr)
+                tb = traceback.format_exc()
+                print("Error occurred on line:", tb.split("\n")[-2].split(",")[1])
+
+                # end run
+                sys.exit("CANNOT CONTINUE GRADING DUE TO STUDENT: " + student['name'])
+
+            for message in student['console']:
+                print(message, file=original_stderr)
+            if not student.get('journaled'):
+                save_to_journal(journal, zip_name, student,
+                                None if results_database is None else results_database.run_id)
+            if results_database is not None:
+                results_database.add_student(zip_name, student)
+            if 'duplicate_of' in student:
+                duplicates_counter += 1
+
+            # Add feedback to students file, the feedback writer saves their folder to the feedback zip
+            feedback_file = None
+            if 'feedback' in student:
+                graded_file = student['file_to_grade'] + '.py'
+                with run_report.stage('feedback text', folder):
+                    feedback_file = (graded_file,) + add_feedback_text(student, student['feedback'],
+                                                                       student['file_to_grade'],
+                                                                       student['py_sources'][graded_file])
+            feedback_writes.append(feedback_writer.submit(feedback_zip.add_student, folder, feedback_file))
+
+            if similarity_index is not None:
+                with run_report.stage('similarity', folder):
+                    similarity_index.add(zip_name, student)
+
+            outcome = student['outcome']
+            if outcome == 'more_than_one_file':  # left out of the CSV, the marker grades them
+                more_than_one_file_counter += 1
+                continue
+            elif outcome in ('infinite_loop', 'id_mismatch'):
+                issues_counter += 1
+            elif outcome == 'input_in_code':
+                issues_counter += 1
+                input_in_code_counter += 1
+            elif outcome == 'resource_limit':
+                issues_counter += 1
+                resource_limit_counter += 1
+            elif outcome == 'syntax_error':
+                syntax_error_counters += 1
+            elif outcome == 'missing_name':
+                missing_names_counter += 1
+            elif outcome == 'wrong_file_name':
                 wrong_file_names_counter += 1
-                feedback_for_student = 'wrong file name: (0/10) -> should be ' + format_keys_dict(
-                    LAB_NAME_GRADING_SOFTWARE_INDEX) + '\n'
-                file_to_grade = py_files_without_extension[0]
-
-        except Exception as e:
-            # In case of bug that was not caught
-
-            # reset the grading folder
-            os.chdir(original_dir)
-            delete_files_except(GRADING_MATERIAL_LOCATION, original_grading_material_files)
-
-            print(f'ERROR due to folder \'{folder}\' \nCONTACT', __maintainer__, 'at:', __email__,
-                  '\nDO NOT ATTEMPT TO GRADE AGAIN WITHOUT DELETING all student folders',
-                  file=original_stderr)
-            print(e, file=original_stderr)
-            tb = traceback.format_exc()
-            print("Error occurred on line:", tb.split("\n")[-2].split(",")[1])
-
-            # end run
-            sys.exit("CANNOT CONTINUE GRADING DUE TO STUDENT: " + name)
-
-        # Add score to dictionary
-        score_dict = {'OrgDefinedId': student_id,
-                      GRADES_CSV_HEADER: score,
-                      "End-of-Line Indicator": '#'}
-        if ADD_NAME_TO_CSV:
-            score_dict['Name'] = name
-        scores.append(score_dict)
-
-
-        # Add feedback to students file
-        add_feedback_text(folder, feedback_for_student, file_to_grade)
-
-    print(
-        f"Done grading '{brightspace_submission_download_zip_names[i]}', "
-        f"Saving feedback to zip folder '{FEEDBACK_ZIP_FOLDER_NAME}-{i + 1}'")
-    zip_folders(folders, f"{FEEDBACK_ZIP_FOLDER_NAME}-{i + 1}", [INDEX_FILE_NAME])
-
-if len(scores) != folder_counter:
-    raise ValueError("Length of grades does not match folders, results invalidated")
-
-print(f"Done grading all folders, there were {folder_counter} students, {issues_counter} could not be graded")
-print(f"\n------additional statistics-----\n"
-      f"students with:\n"
-      f"\tsyntax errors: {syntax_error_counters}\n"
-      f"\twrong filenames: {wrong_file_names_counter}\n"
-      f"\tName/ID missing from file: {missing_names_counter}\n")
-print(f'-------per-function statistics------')
-from statistics import mean
-print('function name\t:\taverage grade')
-for func in grade_stats_dictionary:
-    print(f"{func}: {round( mean(grade_stats_dictionary[func]), 2)}")
-print()
-# csv header
-field_names = list(scores[0].keys())
-
-# save grades to CSV
-print('Saving grades to CSV')
-save_grade_to_CSV(scores, field_names)
-print('Grading Complete')
+            elif student['score'] == -1:  # in case grading software caused an issue
+                issues_counter += 1
+            grade_records.append((zip_name, student['file_to_grade'] if outcome != 'wrong_file_name' else None,
+                                  student['score'], outcome == 'graded' and student['score'] != -1))
+            if student.get('tests'):
+                test_matrices[student['file_to_grade']].add(student['student_id'], student['tests'])
+
+            # Add score to the CSV
+            score_dict = {'OrgDefinedId': student['student_id'],
+                          GRADES_CSV_HEADER: student['score'],
+                          "End-of-Line Indicator": '#'}
+            if ADD_NAME_TO_CSV:
+                score_dict['Name'] = student['name']
+            with run_report.stage('save csv', folder):
+                grades_csv.add(score_dict)
+
+        # every student of the zip must be in the CSV (or left out for the marker)
+        if grades_csv.rows + more_than_one_file_counter != folder_counter:
+            raise ValueError("Length of grades does not match folders, results invalidated")
+
+        print(
+            f"Done grading '{brightspace_submission_download_zip_names[i]}', "
+            f"Saving feedback to zip folder '{FEEDBACK_ZIP_FOLDER_NAME}-{i + 1}'")
+        feedback_writes.append(feedback_writer.submit(feedback_zip.close))
+        if results_database is not None:
+            results_database.commit()
+
+    # Wait for the last feedback zip, an error writing any of them is raised here
+    feedback_writer.shutdown()
+    batch_loader.shutdown()
+    for feedback_write in feedback_writes:
+        feedback_write.result()
+
+    for pool in (grading_pool, shard_pool):
+        if pool is not None:
+            pool.shutdown()
+    close_fork_servers()
+    journal.close()
+    grades_csv.close()
+    if results_database is not None:  # the CSV of the whole run (resumed students included) from its results
+        results_database.export_grades_csv(SAVE_GRADES_TO)
+        results_database.close()
+    shutil.rmtree(workspace_root, ignore_errors=True)
+    if result_cache is not None:
+        result_cache.trim()
+
+    print(f"Done grading all folders, there were {folder_counter} students, {issues_counter} could not be graded")
+    print(f"\n------additional statistics-----\n"
+          f"students with:\n"
+          f"\tsyntax errors: {syntax_error_counters}\n"
+          f"\tinput() in code: {input_in_code_counter}\n"
+          f"\tresource limits exceeded: {resource_limit_counter}\n"
+          f"\twrong filenames: {wrong_file_names_counter}\n"
+          f"\tName/ID missing from file: {missing_names_counter}\n"
+          f"\tidentical submissions to another student: {duplicates_counter}\n")
+    print(f'-------per-function statistics------')
+    grade_report = grade_statistics_report(grade_records)
+    print_grade_statistics(grade_report['run'])
+    if GRADE_STATISTICS_FILE is not None:
+        with open(GRADE_STATISTICS_FILE, 'w', encoding='utf-8') as file:
+            json.dump(grade_report, file, indent=1)
+        print(f'Statistics of each lab and zip saved to {GRADE_STATISTICS_FILE}')
+    print()
+    print_hardest_tests(test_matrices)
+    if TEST_MATRIX_FILE is not None:
+        save_test_matrices(test_matrices, TEST_MATRIX_FILE)
+        print(f'Tests failed by each student saved to {TEST_MATRIX_FILE}')
+    print()
+    if similarity_index is not None:
+        with run_report.stage('similarity'):
+            similarity_report = similarity_index.report()
+        print_similarity(similarity_report)
+        with open(SIMILARITY_REPORT_FILE, 'w', encoding='utf-8') as file:
+            json.dump(similarity_report, file, indent=1)
+        print(f'Alike submissions saved to {SIMILARITY_REPORT_FILE}')
+        print()
+    print(f'Grades saved to {SAVE_GRADES_TO}')
+    if REPORT_FILE is not None:
+        run_report.save(REPORT_FILE)
+        print_stage_times(run_report.summary())
+    if args.trace:
+        run_report.save_trace(args.trace)
+        print(f'Timeline of the run saved to {args.trace}')
+    print('Grading Complete')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,458 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import run_grading_multiple_tests as grader
+
+
+class StudentCodeTestCase(unittest.TestCase):
+    """Runs code the way student code is run, with the forkserver and without it"""
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.addCleanup(grader.close_fork_servers)
+
+    def run_code(self, code: str, use_forkserver: bool = True):
+        grader.USE_FORKSERVER = use_forkserver
+        self.addCleanup(setattr, grader, 'USE_FORKSERVER', True)
+        return grader.run_student_code(code, self.workspace, 10, limits=grader.resource_limits_of('lab'))
+
+
+class StudentProcessTest(StudentCodeTestCase):
+
+    def test_input_stops_the_student(self):
+        for use_forkserver in (True, False):
+            with self.assertRaises(grader.InputInCode):
+                self.run_code('name = input("name?")\n', use_forkserver)
+
+    def test_input_from_redirected_stdin(self):
+        code = 'import io, sys\nsys.stdin = io.StringIO("3\\n")\nprint(int(input()) * 2)\n'
+        for use_forkserver in (True, False):
+            self.assertEqual(self.run_code(code, use_forkserver).stdout, '6\n')
+
+    def test_ctrl_c_kills_the_student(self):
+        code = 'import os, signal\nos.kill(os.getpid(), signal.SIGINT)\n'
+        for use_forkserver in (True, False):
+            grader.thread_state.killed_by_signal = False
+            self.assertEqual(self.run_code(code, use_forkserver).returncode, -grader.signal.SIGINT)
+            self.assertTrue(grader.thread_state.killed_by_signal)
+
+    def test_stopping_the_run(self):
+        self.addCleanup(grader.grading_stopped.clear)
+        for use_forkserver in (True, False):
+            threading.Timer(0.5, grader.grading_stopped.set).start()
+            started = time.monotonic()
+            with self.assertRaises(grader.GradingStopped):
+                self.run_code('import time\ntime.sleep(5)\n', use_forkserver)
+            self.assertLess(time.monotonic() - started, 2)
+            with self.assertRaises(grader.GradingStopped):  # nothing starts once the run is stopping
+                self.run_code('', use_forkserver)
+            grader.grading_stopped.clear()
+
+    def test_student_module_named_like_stdlib(self):
+        with open(os.path.join(self.workspace, 'statistics.py'), 'w') as file:
+            file.write('def mean(values):\n    return "student"\n')
+        code = 'import statistics\nprint(statistics.mean([1, 2]))\n'
+        for use_forkserver in (True, False):
+            self.assertEqual(self.run_code(code, use_forkserver).stdout, 'student\n')
+
+
+class ResourceLimitTest(StudentCodeTestCase):
+    """Limits are found from the errors they raise in the student process, never from its output"""
+
+    def test_memory_limit(self):
+        for use_forkserver in (True, False):
+            with self.assertRaises(grader.ResourceLimitExceeded) as limit:
+                self.run_code('data = bytearray(4 * 1024 ** 3)\n', use_forkserver)
+            self.assertEqual(limit.exception.limit, 'memory_mb')
+
+    def test_error_text_is_not_a_limit(self):
+        code = 'print("MemoryError")\nraise AssertionError("expected a MemoryError")\n'
+        for use_forkserver in (True, False):
+            self.assertEqual(self.run_code(code, use_forkserver).returncode, 1)
+
+    def test_thread_limit_in_a_test(self):
+        # RLIMIT_NPROC does not apply to root, so the failure to start a thread is made by hand
+        code = f'''exec({grader.GRADING_RESULT_CODE!r}, {{}})
+import threading, unittest
+def no_thread(*args, **kwargs):
+    raise RuntimeError("can't start new thread")
+threading._start_new_thread = threading._start_joinable_thread = no_thread
+class Test(unittest.TestCase):
+    def test_thread(self):
+        threading.Thread(target=print).start()
+unittest.main(exit=False)
+'''
+        for use_forkserver in (True, False):
+            with self.assertRaises(grader.ResourceLimitExceeded) as limit:
+                self.run_code(code, use_forkserver)
+            self.assertEqual(limit.exception.limit, 'processes')
+
+    def test_process_limit_leaves_room_for_the_run(self):
+        # every job has a pool thread, a forkserver and a student process besides the processes the student starts
+        settings = {'LAB_NAME_GRADING_SOFTWARE_INDEX': {'lab': 'lab_test'}, 'LAB_TEST_SHARDS': {'lab': 2},
+                    'LAB_RESOURCE_LIMITS': {'lab': {'processes': 10}}}
+        self.assertGreaterEqual(grader.grading_run_processes(24, settings), 3 + 24 * 2 * (3 + 10))
+        self.assertGreater(grader.grading_run_processes(24, settings),
+                           grader.grading_run_processes(24, dict(settings, LAB_TEST_SHARDS={})))
+        self.addCleanup(setattr, grader, 'user_process_limit', grader.user_process_limit)
+        grader.user_process_limit = 500
+        self.assertIn('RLIMIT_NPROC, (500, 500)', grader.resource_limit_code({'processes': 10}))
+
+
+class ShardTest(StudentCodeTestCase):
+    GRADING_SCRIPT = '''import unittest
+from lab import add
+class Test(unittest.TestCase):
+    def test_int(self):
+        self.assertEqual(add(1, 2), 3)
+    def test_negative(self):
+        self.assertEqual(add(-1, -2), -3)
+    def test_zero(self):
+        self.assertEqual(add(0, 0), 0)
+    def test_float(self):
+        self.assertEqual(add(0.5, 0.25), 1)
+    def test_text(self):
+        self.assertEqual(add("a", 1), "a1")
+result = unittest.TextTestRunner().run(unittest.TestLoader().loadTestsFromTestCase(Test))
+passes = result.testsRun - len(result.failures) - len(result.errors)
+'''
+
+    def setUp(self):
+        super().setUp()
+        with open(os.path.join(self.workspace, 'lab.py'), 'w') as file:
+            file.write('def add(a, b):\n    return a + b\n')
+        self.addCleanup(grader.grading_scripts.pop, 'lab_test.py', None)
+        grader.grading_scripts['lab_test.py'] = self.GRADING_SCRIPT
+
+    def result(self, test: str, outcome: str) -> dict:
+        return {'test': test, 'outcome': outcome, 'seconds': 0.1}
+
+    def test_merged_results_are_scored(self):
+        results = [{'score': None, 'tests_run': 2, 'seconds': 1.0,
+                    'tests': [self.result('a', 'pass'), self.result('b', 'fail')]},
+                   {'score': None, 'tests_run': 2, 'seconds': 2.0,
+                    'tests': [self.result('c', 'error'), self.result('d', 'pass')]}]
+        merged = grader.merge_shard_results(results)
+        self.assertEqual(merged['score'], 2.0)  # 2 passes out of 4 tests
+        self.assertEqual((merged['tests_run'], merged['seconds'], len(merged['tests'])), (4, 2.0, 4))
+        self.addCleanup(setattr, grader, 'SCORE_CODE', grader.SCORE_CODE)
+        grader.SCORE_CODE = 'len(result.failures) * 10 + int(result.wasSuccessful())'
+        self.assertEqual(grader.merge_shard_results(results)['score'], 10.0)
+        grader.SCORE_CODE = 'passes / result.missing'
+        self.assertIsNone(grader.merge_shard_results(results))
+
+    def test_sharded_lab_scores_like_unsharded(self):
+        self.addCleanup(setattr, grader, 'shard_pool', grader.shard_pool)
+        grader.shard_pool = grader.ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(grader.shard_pool.shutdown)
+        unsharded = grader.grade('lab_test.py', self.workspace, 10, grader.resource_limits_of('lab'))
+        self.assertEqual(unsharded.result['score'], 2.4)  # 3 passes out of 5 tests
+        for shards in (2, 3):
+            sharded = grader.grade('lab_test.py', self.workspace, 10, grader.resource_limits_of('lab'), shards)
+            self.assertEqual(sharded.result['score'], unsharded.result['score'])
+            self.assertEqual(sorted((test['test'], test['outcome']) for test in sharded.result['tests']),
+                             sorted((test['test'], test['outcome']) for test in unsharded.result['tests']))
+
+
+class CappedOutputTest(unittest.TestCase):
+
+    def capture(self, data: bytes, chunk_size: int, max_bytes: int) -> bytes:
+        output = grader.CappedOutput(max_bytes)
+        for start in range(0, len(data), chunk_size):
+            output.write(data[start:start + chunk_size])
+        return output.getvalue()
+
+    def test_short_output_is_kept(self):
+        for chunk_size in (1, 3, 10):
+            self.assertEqual(self.capture(b'0123456789', chunk_size, 10), b'0123456789')
+
+    def test_start_and_end_of_long_output_are_kept(self):
+        for chunk_size in (1, 3, 7, 16):
+            self.assertEqual(self.capture(b'0123456789abcdef', chunk_size, 10),
+                             b'01234' + grader.elision_marker(6) + b'bcdef')
+
+    def test_same_as_output_read_from_a_file(self):
+        # output of forked student processes is read back from a file, it is kept the same way
+        data = bytes(range(256)) * 50
+        path = os.path.join(tempfile.mkdtemp(), 'output')
+        with open(path, 'wb') as file:
+            file.write(data)
+        for max_bytes in (1001, 1024, len(data)):
+            self.assertEqual(grader.decode_output(self.capture(data, 333, max_bytes)),
+                             grader.read_output(path, max_bytes))
+
+
+class WorkspaceTest(StudentCodeTestCase):
+
+    def test_student_writes_stay_in_the_workspace(self):
+        folder = tempfile.mkdtemp()
+        material = os.path.join(folder, grader.GRADING_MATERIAL_LOCATION)
+        os.mkdir(material)
+        for filename in ('data.csv', 'lab_test.py'):
+            with open(os.path.join(material, filename), 'w') as file:
+                file.write('original')
+        cwd = os.getcwd()
+        os.chdir(folder)
+        self.addCleanup(os.chdir, cwd)
+        self.workspace = grader.create_student_workspace(folder, {'lab.py': b''})
+        self.run_code('open("data.csv", "w").write("changed")\nopen("lab_test.py", "w").write("changed")\n')
+        for filename in ('data.csv', 'lab_test.py'):
+            with open(os.path.join(material, filename)) as file:
+                self.assertEqual(file.read(), 'original')
+
+
+class MaterialHashTest(unittest.TestCase):
+
+    def setUp(self):
+        self.material = tempfile.mkdtemp()
+        for filename in ('lab1_test.py', 'lab2_test.py', 'data.csv'):
+            self.write(filename, 'original')
+        for name, value in (('GRADING_MATERIAL_LOCATION', self.material),
+                            ('LAB_NAME_GRADING_SOFTWARE_INDEX', {'lab1': 'lab1_test', 'lab2': 'lab2_test'})):
+            self.addCleanup(setattr, grader, name, getattr(grader, name))
+            setattr(grader, name, value)
+
+    def write(self, filename: str, contents: str):
+        with open(os.path.join(self.material, filename), 'w') as file:
+            file.write(contents)
+
+    def test_grading_script_of_another_lab(self):
+        material_hash = grader.material_hash('lab1')
+        self.write('lab2_test.py', 'changed')
+        self.assertEqual(grader.material_hash('lab1'), material_hash)
+        self.write('lab1_test.py', 'changed')
+        self.assertNotEqual(grader.material_hash('lab1'), material_hash)
+
+    def test_data_file(self):
+        material_hash = grader.material_hash('lab1')
+        self.write('data.csv', 'changed')
+        self.assertNotEqual(grader.material_hash('lab1'), material_hash)
+
+
+class RoundUpTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in (('TIMEOUT_MULTIPLIER', 10), ('MIN_TIMEOUT', 0.5), ('MAX_TIMEOUT', 60)):
+            self.addCleanup(setattr, grader, name, getattr(grader, name))
+            setattr(grader, name, value)
+
+    def test_rounded_up_to_1_2_5(self):
+        for seconds, timeout in ((0.06, 1), (0.1, 1), (0.12, 2), (0.2, 2), (0.21, 5), (0.3, 5), (0.7, 10),
+                                 (1.5, 20), (3, 50)):
+            self.assertEqual(grader.round_up_timeout(seconds), timeout, seconds)
+
+    def test_kept_between_min_and_max(self):
+        self.assertEqual(grader.round_up_timeout(0), 0.5)
+        self.assertEqual(grader.round_up_timeout(0.03), 0.5)
+        self.assertEqual(grader.round_up_timeout(5.5), 60)  # not 100
+        self.assertEqual(grader.round_up_timeout(100), 60)
+
+    def test_close_measurements_get_the_same_timeout(self):
+        self.assertEqual({grader.round_up_timeout(seconds) for seconds in (0.23, 0.31, 0.38, 0.45)}, {5})
+
+
+class SubmissionKeyTest(unittest.TestCase):
+    SOURCES = {'lab1.py': b'print("lab")\n'}
+
+    def setUp(self):
+        for name, value in (('LAB_NAME_GRADING_SOFTWARE_INDEX', {'lab1': 'lab1_test'}),
+                            ('grading_material_hashes', {'lab1': 'material'}), ('lab_timeouts', {})):
+            self.addCleanup(setattr, grader, name, getattr(grader, name))
+            setattr(grader, name, value)
+
+    def test_output_kept_in_the_feedback(self):
+        key = grader.submission_key('lab1', self.SOURCES)
+        self.addCleanup(setattr, grader, 'MAX_OUTPUT_KB', grader.MAX_OUTPUT_KB)
+        grader.MAX_OUTPUT_KB *= 2
+        self.assertNotEqual(grader.submission_key('lab1', self.SOURCES), key)
+
+    def test_calibrated_timeouts(self):
+        # the calibrated timeouts may round to another value on each run, cached results stay usable
+        key = grader.submission_key('lab1', self.SOURCES)
+        grader.lab_timeouts = {'lab1': (1, 5)}
+        self.assertEqual(grader.submission_key('lab1', self.SOURCES), key)
+        self.addCleanup(setattr, grader, 'TIMEOUT', grader.TIMEOUT)
+        grader.TIMEOUT += 1
+        self.assertNotEqual(grader.submission_key('lab1', self.SOURCES), key)
+
+
+class ResultCacheTest(unittest.TestCase):
+    SOURCES = {'lab1.py': b'__student_number__ = "1"\n'}
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.runs = []  # student ID of every run_checks call
+        for name, value in (('LAB_NAME_GRADING_SOFTWARE_INDEX', {'lab1': 'lab1_test'}),
+                            ('grading_material_hashes', {'lab1': 'material'}), ('run_checks', self.run_checks),
+                            ('result_cache', grader.ResultCache(self.location, 1024 ** 2))):
+            self.addCleanup(setattr, grader, name, getattr(grader, name))
+            setattr(grader, name, value)
+
+    def run_checks(self, folder, py_sources, file_to_grade, student_id, root, identity):
+        # the file gives ID 1, so it is only graded for student 1
+        self.runs.append(student_id)
+        grading_run = None
+        if student_id == '1':
+            grading_run = grader.subprocess.CompletedProcess(['grading'], 0, 'output', '')
+            grading_run.result = {'score': 4.0}
+        return '1', 'a', grading_run
+
+    def check(self, student_id: str) -> tuple:
+        student = {'folder': student_id, 'student_id': student_id, 'name': 'a', 'py_sources': self.SOURCES,
+                   'console': []}
+        return grader.check_submission(student, 'lab1', self.location)
+
+    def entry(self, **changes) -> dict:
+        return dict({'given_id': '1', 'given_author': 'a', 'grading': {'stdout': '', 'result': None}}, **changes)
+
+    def test_unreliable_results_are_not_saved(self):
+        cache = grader.result_cache
+        for key, entry in (('timeout', self.entry(grading='TimeoutExpired')),
+                           ('identity timeout', self.entry(given_id='TimeoutExpired')),
+                           ('limit', self.entry(grading={'resource_limit': 'memory_mb'})),
+                           ('identity limit', self.entry(given_id='ResourceLimitExceeded')),
+                           ('killed', self.entry(killed_by_signal=True))):
+            cache.save(key, entry)
+            self.assertIsNone(cache.load(key), key)
+        cache.save('graded', self.entry())
+        self.assertEqual(cache.load('graded'), self.entry())
+        self.addCleanup(grader.grading_stopped.clear)
+        grader.grading_stopped.set()
+        cache.save('stopping', self.entry())
+        self.assertIsNone(cache.load('stopping'))
+
+    def test_result_without_grading_is_not_reused_for_a_student_needing_it(self):
+        self.assertIsNone(self.check('2')[2])  # wrong ID, not graded
+        self.assertIsNone(self.check('3')[2])
+        grader.result_cache = grader.ResultCache(self.location, 1024 ** 2)  # the next run
+        self.assertEqual(self.check('1')[2].result, {'score': 4.0})
+        self.assertEqual(self.check('2')[2].result, {'score': 4.0})  # a graded result does for everyone
+        self.assertEqual(self.runs, ['2', '1'])
+
+
+class PrescreenTest(StudentCodeTestCase):
+    SOURCES = {'lab.py': b'import math\n__author__ = "a"\n__student_number__ = "1"\n__team__ = "t"\n'}
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, grader, 'original_grading_material_files', grader.original_grading_material_files)
+        grader.original_grading_material_files = []
+
+    @unittest.skipUnless(hasattr(sys, 'stdlib_module_names'), 'needs Python 3.10')
+    def test_standard_library_import(self):
+        self.assertEqual(grader.prescreen_submission(self.SOURCES, 'lab'), ('1', 'a'))
+
+    def test_standard_library_import_before_python_3_10(self):
+        # sys.stdlib_module_names is new in Python 3.10, the file is run instead of read
+        if hasattr(sys, 'stdlib_module_names'):
+            self.addCleanup(setattr, sys, 'stdlib_module_names', sys.stdlib_module_names)
+            del sys.stdlib_module_names
+        self.assertIsNone(grader.prescreen_submission(self.SOURCES, 'lab'))
+
+    def test_same_identity_as_importing_the_file(self):
+        literals = ['101000000', '"101 000 000"', '-1', '1.50', '1e3', '0x1F', '1_000', 'True', 'None', '1j', "b'1'",
+                    '(1, "a")', '[1, 2]', '{"a": 1}', '{1}', '"Émilie Dubois"', '""', '"a\\tb"', "'''a'''"]
+        for literal in literals:
+            for team in ('__team__ = "t"\n', ''):
+                source = f'__author__ = {literal}\n__student_number__ = {literal}\n{team}def f():\n    pass\n'
+                with self.subTest(source=source):
+                    with open(os.path.join(self.workspace, 'lab.py'), 'w', encoding='utf-8') as file:
+                        file.write(source)
+                    prescreened = grader.prescreen_submission({'lab.py': source.encode()}, 'lab')
+                    self.assertIsNotNone(prescreened)
+                    imported = grader.get_id_and_author('lab', self.workspace, grader.TEAM_NAME_CHECK, timeout=10)
+                    self.assertEqual(prescreened, imported)
+
+    def test_syntax_error_like_importing_the_file(self):
+        source = '__author__ = "a"\n__student_number__ = "1"\n__team__ = "t"\nprint("a"\n'
+        with open(os.path.join(self.workspace, 'lab.py'), 'w') as file:
+            file.write(source)
+        for identity in (grader.prescreen_submission({'lab.py': source.encode()}, 'lab'),
+                         grader.get_id_and_author('lab', self.workspace, True, timeout=10)):
+            self.assertEqual(identity, ('syntaxError', 'syntaxError'))
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'journal.jsonl')
+
+    def student(self, folder: str, score) -> dict:
+        return {'folder': folder, 'name': 'name', 'student_id': folder, 'score': score, 'feedback': 'feedback',
+                'file_to_grade': 'lab', 'outcome': 'graded', 'seconds': 1.5, 'tests': {'test_a': 'pass'},
+                'console': ['not journaled']}
+
+    def test_resume_replays_saved_students(self):
+        with open(self.path, 'w', encoding='utf-8') as journal:
+            grader.save_to_journal(journal, grader.DO_NOT_UPLOAD_PREFIX + 'batch.zip', self.student('1', 4.0), 7)
+            grader.save_to_journal(journal, 'batch.zip', self.student('2', 0), 7)
+            journal.write('{"zip": "batch.zip", "folder": "3", "sc')  # the run was killed while saving it
+        journaled = grader.load_journal(self.path)
+        self.assertEqual(list(journaled), [('batch.zip', '1'), ('batch.zip', '2')])
+        record = journaled[('batch.zip', '1')]
+        expected = dict.fromkeys(grader.JOURNAL_FIELDS)  # given_id, duplicate_of... the student does not have
+        expected.update(self.student('1', 4.0))
+        del expected['console']
+        self.assertEqual({field: record[field] for field in grader.JOURNAL_FIELDS}, expected)
+        self.assertEqual((record['run_id'], journaled[('batch.zip', '2')]['score']), (7, 0))
+
+    def test_no_journal(self):
+        self.assertEqual(grader.load_journal(self.path), {})
+
+
+class ResultsDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'results.sqlite')
+
+    def student(self, folder: str, journaled: bool = False) -> dict:
+        return {'folder': folder, 'student_id': folder, 'name': 'name', 'file_to_grade': 'lab', 'score': 4,
+                'outcome': 'graded', 'seconds': 1.0, 'feedback': 'feedback', 'journaled': journaled}
+
+    def test_resumed_run_adds_no_duplicates(self):
+        database = grader.ResultsDatabase(self.path)
+        database.add_student('zip', self.student('1'))
+        database.close()
+        # the run was killed after journaling student 2, before its row was saved
+        database = grader.ResultsDatabase(self.path, database.run_id)
+        database.add_student('zip', self.student('1', journaled=True))
+        database.add_student('zip', self.student('2', journaled=True))
+        database.add_student('zip', self.student('3'))
+        database.close()
+        connection = sqlite3.connect(self.path)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM runs').fetchone(), (1,))
+        self.assertEqual(connection.execute('SELECT folder FROM results ORDER BY folder').fetchall(),
+                         [('1',), ('2',), ('3',)])
+        connection.close()
+
+    def test_identity_in_the_file(self):
+        student = dict(self.student('1'), outcome='id_mismatch', given_id='2', given_author='someone else')
+        database = grader.ResultsDatabase(self.path)
+        database.add_student('zip', student)
+        database.close()
+        connection = sqlite3.connect(self.path)
+        self.assertEqual(connection.execute('SELECT given_id, given_author FROM results').fetchall(),
+                         [('2', 'someone else')])
+        connection.close()
+
+    def test_export_grades_csv(self):
+        database = grader.ResultsDatabase(self.path)
+        database.add_student('zip', self.student('1'))
+        database.add_student('zip', dict(self.student('2'), score=0.0, outcome='syntax_error'))
+        database.add_student('zip', dict(self.student('3'), outcome='more_than_one_file'))  # graded by the marker
+        database.close()
+        csv_path = os.path.join(os.path.dirname(self.path), 'grades.csv')
+        grader.ResultsDatabase(self.path, database.run_id).export_grades_csv(csv_path)
+        with open(csv_path, encoding='UTF8') as file:
+            self.assertEqual(file.read().splitlines(),
+                             [f'OrgDefinedId,{grader.GRADES_CSV_HEADER},End-of-Line Indicator', '1,4,#', '2,0.0,#'])
+
+
+if __name__ == '__main__':
+    unittest.main()